@@ -1,7 +1,121 @@
 import tornado.gen as gen
 from tornado.ioloop import IOLoop
+import socket
 import traceback
 
+from stats import LayerStats
+
+# An already-resolved Future. Layers whose work finished synchronously return
+# this instead of creating a Future per message, and callers can still `yield`
+# it. Never set its result.
+DONE = gen.Future()
+DONE.set_result(None)
+
+def pretty_mac(mac):
+    return ":".join(["{:02x}".format(ord(x)) for x in mac])
+
+def wire_mac(mac):
+    return "".join([chr(int(x, 16)) for x in mac.split(":")])
+
+pretty_ip = socket.inet_ntoa
+wire_ip = socket.inet_aton
+
+class PacketContext(object):
+    # The `header` passed along with a packet between layers
+    # Fields filled in by the Ethernet/IP/UDP/TCP layers live in slots, the
+    # rest in a dict created the first time one is set. It can be used like
+    # the plain dicts layers used to get: header["ip_src"], "key" in header...
+    # MAC and IP addresses are kept in wire form end-to-end; use `pretty`
+    # to format them for display.
+    __slots__ = ("eth_dst", "eth_src", "eth_type",
+                 "ip_id", "ip_dst", "ip_src", "ip_p",
+                 "udp_sport", "udp_dport", "udp_conn", "tcp_conn", "extra")
+
+    FIELDS = frozenset(__slots__[:-1])
+
+    PRETTY = {
+        "eth_dst": pretty_mac,
+        "eth_src": pretty_mac,
+        "ip_dst": pretty_ip,
+        "ip_src": pretty_ip,
+    }
+
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    def pretty(self, key):
+        # Human-readable form of a field
+        value = self[key]
+        if key in self.PRETTY:
+            return self.PRETTY[key](value)
+        return value
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in self.FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in self.__slots__[:-1] if hasattr(self, key)]
+        if self.extra is not None:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def copy(self):
+        new = PacketContext()
+        for slot in self.__slots__[:-1]:
+            if hasattr(self, slot):
+                setattr(new, slot, getattr(self, slot))
+        if self.extra is not None:
+            new.extra = self.extra.copy()
+        return new
+
+    def __repr__(self):
+        return "PacketContext({})".format(", ".join("{}={!r}".format(k, self.pretty(k)) for k in self.keys()))
+
 class LayerMeta(type):
     layer_classes = {}
     instance_callback = None
@@ -25,33 +139,130 @@ class NetLayer(object):
         0: 1
     }
 
+    # Layers whose `match` only compares header values for equality can set
+    # DISPATCH_KEY and implement `dispatch_values` & `dispatch_lookup`, so their
+    # parent finds them with a hash lookup instead of calling `match` on each
+    # child in turn. Siblings sharing a DISPATCH_KEY share one index.
+    DISPATCH_KEY = None
+
+    # Whether `match` gives the same answer for packets going either way on
+    # a flow. Flows are only bypassed if all of a layer's children do.
+    SYMMETRIC_MATCH = True
+
     def __init__(self, debug=False):
         self.children = []
+        self.dispatch_table = None
         self.debug = debug
+        self.debug_sample = 1
+        self.debug_count = 0
         self.loggers = []
         self.name = self.NAME
+        self.stats = LayerStats(self)
 
     def cleanup(self):
         for child in self.children:
             child.cleanup()
 
+    def attached(self):
+        # Override me  -- called when this layer (or one below it) is
+        # registered under a parent. Layers are cleaned up when they're
+        # unregistered, including by shell commands that just move them, so
+        # this should undo `cleanup`.
+        for child in self.children:
+            child.attached()
+
     def register_child(self, child):
         self.children.append(child)
         child.parent = self
+        child.attached()
+        self.dispatch_table = None
+        self.find_root().on_tree_changed()
 
     def unregister_child(self, child):
         self.children.remove(child)
         child.cleanup()
+        self.dispatch_table = None
+        self.find_root().on_tree_changed()
+
+    def invalidate_dispatch(self):
+        # Call when the values returned by `dispatch_values` change
+        parent = getattr(self, "parent", None)
+        if parent is not None:
+            parent.dispatch_table = None
+            self.find_root().on_tree_changed()
+
+    def find_root(self):
+        layer = self
+        while getattr(layer, "parent", None) is not None:
+            layer = layer.parent
+        return layer
+
+    def on_tree_changed(self):
+        # Override me  -- called on the root when a layer is added or removed
+        pass
+
+    def bypass(self, header, sport, dport):
+        # Declare that no layer wants to modify the flow `header` belongs to,
+        # so the source layer may forward the rest of it as raw frames
+        if not all(child.SYMMETRIC_MATCH for child in self.children):
+            # A child might still want packets going the other way
+            return
+        add_bypass = getattr(self.find_root(), "add_bypass", None)
+        if add_bypass is not None:
+            add_bypass(header, sport, dport)
+
+    def build_dispatch(self):
+        # Compile `children` into a list of (lookup, index) steps, in order.
+        # Consecutive children with the same DISPATCH_KEY are merged into one
+        # step whose index maps header values to (position, child); any other
+        # child becomes a (child, None) step which is resolved with `match`.
+        steps = []
+        last_key = None
+        for position, child in enumerate(self.children):
+            key = child.DISPATCH_KEY
+            if key is None:
+                steps.append((child, None))
+            else:
+                if key != last_key:
+                    steps.append((child.dispatch_lookup, {}))
+                index = steps[-1][1]
+                for value in child.dispatch_values():
+                    index.setdefault(value, (position, child))
+            last_key = key
+        return steps
 
     def resolve_child(self, src, header):
-        for child in self.children:
-            if child.match(src, header):
-                return child
+        if self.dispatch_table is None:
+            self.dispatch_table = self.build_dispatch()
+        for lookup, index in self.dispatch_table:
+            if index is None:
+                if lookup.match(src, header):
+                    return lookup
+                continue
+            found = None
+            for value in lookup(header):
+                hit = index.get(value)
+                if hit is not None and (found is None or hit[0] < found[0]):
+                    found = hit
+            if found is not None:
+                return found[1]
 
     def match(self, src, header):
         # Override me 
         return True # match everything
 
+    def dispatch_values(self):
+        # Override me  -- if DISPATCH_KEY is set
+        # Header values this layer matches
+        return ()
+
+    @staticmethod
+    def dispatch_lookup(header):
+        # Override me  -- if DISPATCH_KEY is set
+        # Header values to look up in the parent's index for a packet.
+        # Must agree with `match`.
+        return ()
+
     # coroutine
     def on_read(self, src, header, payload):
         # Override me 
@@ -69,11 +280,12 @@ class NetLayer(object):
         # How does this layer handle messages?
         return self.write_back(dst, header, payload)
 
-    @gen.coroutine
+    # coroutine
     def close_bubble(self, src, header):
         child = self.resolve_child(src, header)
         if child is not None:
-            child.on_close(src, header)
+            return child.on_close(src, header) or DONE
+        return DONE
 
     # coroutine
     def bubble(self, src, header, payload):
@@ -83,16 +295,16 @@ class NetLayer(object):
         child = self.resolve_child(src, header)
         if child is not None:
             #print self.NAME,"->",child.NAME
-            return child.on_read(src, header, payload)
+            return child.on_read(src, header, payload) or DONE
         else:
             #print self.NAME, "loop"
-            return self.write(self.route(src, header), header, payload)
+            return self.write(self.route(src, header), header, payload) or DONE
 
-    @gen.coroutine
+    # coroutine
     def write_back(self, dst, header, payload):
         if self.parent is None:
             raise Exception("Unable to write_back, no parent on %s" % self)
-        yield self.parent.write(dst, header, payload)
+        return self.parent.write(dst, header, payload) or DONE
 
     # coroutine
     def passthru(self, src, header, payload):
@@ -110,13 +322,27 @@ class NetLayer(object):
 
     def log(self, msg, *args, **kwargs):
         # Log a message to the screen or to a file
-        # Mediated by `self.debug` and the layer's `debug` command
+        # Mediated by `self.debug` and the layer's `debug` command, which can
+        # also pass only 1 in every `debug_sample` messages to debug handlers.
+        # The message is only formatted if some handler will receive it.
+        # `msg` may also be a function returning the message, for messages
+        # that are expensive to build even before formatting.
+        debug = self.debug
+        if debug and self.debug_sample > 1:
+            self.debug_count += 1
+            debug = self.debug_count % self.debug_sample == 0
+
+        log_handlers = [log_handler for debug_only, log_handler in self.loggers if debug or not debug_only]
+        if not log_handlers:
+            return
 
-        log_message = msg.format(*args, **kwargs)
+        if callable(msg):
+            log_message = msg()
+        else:
+            log_message = msg.format(*args, **kwargs)
 
-        for debug_only, log_handler in self.loggers:
-            if self.debug or not debug_only:
-                log_handler(log_message)
+        for log_handler in log_handlers:
+            log_handler(log_message)
 
     def add_logger(self, handler, debug_only=False):
         # Add a function to be called on `log` events
@@ -138,15 +364,43 @@ class NetLayer(object):
         return default
 
     def do_debug(self, *args):
-        """Toggle debugging on this layer."""
+        """debug [on|off|<n>] - Toggle debugging on this layer, or log 1 in <n> debug messages."""
         # Shell command handler for 'debug' to toggle self.debug
-        self.debug = not self.debug
+        if not args:
+            self.debug = not self.debug
+        elif args[0] == "on":
+            self.debug = True
+        elif args[0] == "off":
+            self.debug = False
+        else:
+            self.debug = True
+            self.debug_sample = max(1, int(args[0]))
+            self.debug_count = 0
+        if self.debug and self.debug_sample > 1:
+            return "Debug: on (1 in {})".format(self.debug_sample)
         return "Debug: {}".format("on" if self.debug else "off")
 
+    def do_stats(self, *args):
+        """stats [on|off|reset] - Show or control packet counts & timings."""
+        if args:
+            if args[0] == "on":
+                self.stats.enable()
+            elif args[0] == "off":
+                self.stats.disable()
+            elif args[0] == "reset":
+                self.stats.reset()
+            else:
+                raise Exception("Unknown stats command '{}'".format(args[0]))
+        return str(self.stats)
+
     def add_future(self, future):
-        if future is not None:
+        if future is not None and future is not DONE:
             def result(f):
                 if f.exception():
                     exc_type, exc_value, exc_traceback = f.exc_info()
                     traceback.print_exception(exc_type, exc_value, exc_traceback)
-            IOLoop.instance().add_future(future, result)
+            if future.done():
+                # Nothing to wait for, so don't schedule a callback
+                result(future)
+            else:
+                IOLoop.instance().add_future(future, result)
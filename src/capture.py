@@ -0,0 +1,128 @@
+# Reading & writing capture files (pcap and pcapng) of Ethernet frames
+
+import struct
+
+import dpkt
+
+DLT_EN10MB = 1
+
+# Magic number -> (byte order, timestamp resolution)
+PCAP_MAGIC = {
+    "\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    "\xa1\xb2\xc3\xd4": (">", 1e-6),
+    "\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    "\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 1
+PCAPNG_PB = 2
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+PCAPNG_OPT_TSRESOL = 9
+
+def read_capture(f):
+    # Yield (timestamp, interface, frame) for each Ethernet frame in the pcap
+    # or pcapng file `f`. `interface` is the pcapng interface id, or None for
+    # pcap files, which only have one.
+    magic = f.read(4)
+    if magic in PCAP_MAGIC:
+        return read_pcap(f, *PCAP_MAGIC[magic])
+    elif len(magic) == 4 and struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+        return read_pcapng(f)
+    raise ValueError("Not a pcap or pcapng file")
+
+def read_pcap(f, order, resolution):
+    _major, _minor, _zone, _sigfigs, _snaplen, linktype = struct.unpack(order + "HHiIII", f.read(20))
+    if linktype != DLT_EN10MB:
+        raise ValueError("Unsupported link type {} (only Ethernet is supported)".format(linktype))
+    record = struct.Struct(order + "IIII")
+    while True:
+        head = f.read(record.size)
+        if len(head) < record.size:
+            return
+        sec, frac, caplen, _length = record.unpack(head)
+        frame = f.read(caplen)
+        if len(frame) < caplen:
+            return
+        yield sec + frac * resolution, None, frame
+
+def pcapng_tsresol(options, order):
+    # Timestamp resolution from an Interface Description Block's options
+    offset = 0
+    while offset + 4 <= len(options):
+        code, length = struct.unpack_from(order + "HH", options, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL and length >= 1:
+            value = ord(options[offset + 4])
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7F)
+            return 10.0 ** -value
+        offset += 4 + length + (-length % 4)
+    return 1e-6
+
+def read_pcapng(f):
+    # The Section Header Block's magic has already been read
+    order = "<"
+    interfaces = []
+    block_type = PCAPNG_SHB
+    ts = 0
+    while True:
+        if block_type == PCAPNG_SHB:
+            head = f.read(8)
+            if len(head) < 8:
+                return
+            order = "<" if struct.unpack("<I", head[4:])[0] == PCAPNG_BYTE_ORDER else ">"
+            length, = struct.unpack(order + "I", head[:4])
+            f.read(length - 12)
+            # Interface ids are numbered per section
+            interfaces = []
+        else:
+            head = f.read(4)
+            if len(head) < 4:
+                return
+            length, = struct.unpack(order + "I", head)
+            body = f.read(length - 12)
+            f.read(4)
+            if len(body) < length - 12:
+                return
+
+            if block_type == PCAPNG_IDB:
+                linktype, _reserved, _snaplen = struct.unpack_from(order + "HHI", body)
+                interfaces.append((linktype, pcapng_tsresol(body[8:], order)))
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    interface, ts_high, ts_low, caplen, _length = struct.unpack_from(order + "IIIII", body)
+                else:
+                    interface, _drops, ts_high, ts_low, caplen, _length = struct.unpack_from(order + "HHIIII", body)
+                if interface < len(interfaces) and interfaces[interface][0] == DLT_EN10MB:
+                    ts = ((ts_high << 32) | ts_low) * interfaces[interface][1]
+                    yield ts, interface, body[20:20 + caplen]
+            elif block_type == PCAPNG_SPB:
+                # No interface id or timestamp: always interface 0
+                if interfaces and interfaces[0][0] == DLT_EN10MB:
+                    original, = struct.unpack_from(order + "I", body)
+                    yield ts, 0, body[4:4 + original]
+
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        block_type, = struct.unpack(order + "I", head)
+
+class CaptureWriter(object):
+    # Writes Ethernet frames to a pcap file
+    SNAPLEN = 65535
+
+    def __init__(self, filename):
+        self.f = open(filename, "wb")
+        self.writer = dpkt.pcap.Writer(self.f, snaplen=self.SNAPLEN)
+        self.count = 0
+
+    def write(self, ts, frame):
+        self.writer.writepkt(frame, ts=ts)
+        self.count += 1
+
+    def close(self):
+        self.f.close()
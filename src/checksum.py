@@ -0,0 +1,44 @@
+# Internet checksum helpers (RFC 1071) with incremental updates (RFC 1624)
+#
+# Partial sums are kept as folded 16-bit one's complement sums of
+# big-endian words, so they can be added together in any order and turned
+# into a checksum with `cksum_done`.
+
+import dpkt
+import struct
+import sys
+
+PSEUDO_HEADER = struct.Struct("!4s4sxBH")
+
+def cksum_fold(s):
+    s = (s & 0xFFFF) + (s >> 16)
+    s = (s & 0xFFFF) + (s >> 16)
+    return s
+
+def cksum_add(data, s=0):
+    # Add the words of `data` (padded with a zero byte if odd) to sum `s`
+    n = cksum_fold(dpkt.in_cksum_add(0, data))
+    if sys.byteorder == "little":
+        n = ((n & 0xFF) << 8) | (n >> 8)
+    return cksum_fold(s + n)
+
+def cksum_sub(s, x):
+    # Remove partial sum `x` from partial sum `s`
+    return cksum_fold(s + (~x & 0xFFFF))
+
+def cksum_done(s):
+    # Turn a partial sum into the value stored in a checksum field
+    return ~s & 0xFFFF
+
+def cksum_update(cksum, old, new):
+    # RFC 1624 eqn. 3: HC' = ~(~HC + ~m + m')
+    # Update checksum `cksum` for a 16-bit word changing from `old` to `new`
+    return ~cksum_fold((~cksum & 0xFFFF) + (~old & 0xFFFF) + new) & 0xFFFF
+
+def pseudo_header_sum(src, dst, p, length=0):
+    # Partial sum of the TCP/UDP pseudo-header for wire-form IPv4 addresses
+    return cksum_add(PSEUDO_HEADER.pack(src, dst, p, length))
+
+def segment_cksum_ok(src, dst, p, segment):
+    # Verify the checksum of a whole TCP/UDP segment (as a string)
+    return cksum_add(segment, pseudo_header_sum(src, dst, p, len(segment))) == 0xFFFF
@@ -0,0 +1,91 @@
+# Control sockets for lens processes running as shards of the same tap
+#
+# Each shard listens on a unix socket named after its index. A client sends
+# shell command lines (newline-terminated), and gets back each command's
+# output terminated by a NUL byte. Commands may return a Future, which is
+# waited for before the output is sent.
+
+import glob
+import os
+import re
+import socket
+import time
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import add_accept_handler, bind_unix_socket
+
+PATH = "/tmp/lens-shard-{}.sock"
+TIMEOUT = 5.0
+
+class ControlServer(object):
+    def __init__(self, run_command, index, path=PATH):
+        # `run_command(line)` returns the output of a shell command line
+        self.run_command = run_command
+        self.index = index
+        self.path_format = path
+        self.path = path.format(index)
+        self.sock = bind_unix_socket(self.path)
+        add_accept_handler(self.sock, self.on_connection, IOLoop.instance())
+
+    def on_connection(self, conn, address):
+        self.serve(IOStream(conn))
+
+    @gen.coroutine
+    def serve(self, stream):
+        try:
+            while True:
+                line = yield stream.read_until("\n")
+                try:
+                    result = self.run_command(line)
+                    if isinstance(result, Future):
+                        result = yield result
+                except Exception as e:
+                    result = "Error running '{}': {}".format(line.strip(), e.__class__.__name__)
+                yield stream.write(("" if result is None else str(result)) + "\0")
+        except StreamClosedError:
+            pass
+
+    def shard_paths(self):
+        return shard_paths(self.path_format)
+
+    def close(self):
+        IOLoop.instance().remove_handler(self.sock.fileno())
+        self.sock.close()
+        os.unlink(self.path)
+
+def shard_paths(path=PATH):
+    # (index, path) of every shard's control socket, in order
+    pattern = re.compile(re.escape(path).replace(re.escape("{}"), "([0-9]+)") + "$")
+    found = []
+    for candidate in glob.glob(path.format("*")):
+        match = pattern.match(candidate)
+        if match:
+            found.append((int(match.group(1)), candidate))
+    return sorted(found)
+
+@gen.coroutine
+def query(path, line, timeout=TIMEOUT):
+    # Run a command on the shard listening on `path`, without blocking the
+    # IOLoop. Fails with gen.TimeoutError if there's no reply in `timeout`.
+    stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+    deadline = IOLoop.current().time() + timeout
+    wait = lambda future: gen.with_timeout(deadline, future, quiet_exceptions=StreamClosedError)
+    try:
+        yield wait(stream.connect(path))
+        yield wait(stream.write(line.strip() + "\n"))
+        reply = yield wait(stream.read_until("\0"))
+        raise gen.Return(reply.rstrip("\0"))
+    finally:
+        stream.close()
+
+def wait_for(path, timeout):
+    # Block until a control socket exists at `path`; returns False on timeout
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
@@ -1,44 +1,36 @@
 import dpkt
-import tornado.gen as gen
-from base import NetLayer
+import struct
+import base
+from base import NetLayer, PacketContext
 
 class EthernetLayer(NetLayer):
     NAME = "eth"
+    HEADER = struct.Struct("!6s6sH")
 
     def __init__(self, *args, **kwargs):
         super(EthernetLayer, self).__init__(*args, **kwargs)
         self.seen_macs = {k: set() for k in self.routing.keys()}
 
-    @staticmethod
-    def pretty_mac(mac):
-        return ":".join(["{:02x}".format(ord(x)) for x in mac])
-    @staticmethod
-    def wire_mac(mac):
-        return "".join([chr(int(x, 16)) for x in mac.split(":")])
+    pretty_mac = staticmethod(base.pretty_mac)
+    wire_mac = staticmethod(base.wire_mac)
 
-    @gen.coroutine
+    # coroutine
     def on_read(self, src, header, data):
         try:
             pkt = dpkt.ethernet.Ethernet(data)
         except dpkt.NeedData:
-            yield self.passthru(src, header, data)
-            return
-        header = {
-            "eth_dst": self.pretty_mac(pkt.dst),
-            "eth_src": self.pretty_mac(pkt.src),
-            "eth_type": pkt.type,
-        }
-        self.seen_macs[src].add(header["eth_src"])
-        yield self.bubble(src, header, pkt.data)
+            return self.passthru(src, header, data)
+        header = PacketContext()
+        header.eth_dst = pkt.dst
+        header.eth_src = pkt.src
+        header.eth_type = pkt.type
+        self.seen_macs[src].add(pkt.src)
+        return self.bubble(src, header, pkt.data)
 
-    @gen.coroutine
+    # coroutine
     def write(self, dst, header, payload):
-        pkt = dpkt.ethernet.Ethernet(
-                dst=self.wire_mac(header["eth_dst"]),
-                src=self.wire_mac(header["eth_src"]),
-                type=header["eth_type"],
-                data=payload)
-        yield self.write_back(dst, header, str(pkt))
+        frame = self.HEADER.pack(header["eth_dst"], header["eth_src"], header["eth_type"]) + str(payload)
+        return self.write_back(dst, header, frame)
 
     def do_list(self):
         """List MAC addresses that have sent data to attached NICs."""
@@ -46,6 +38,6 @@ class EthernetLayer(NetLayer):
         for src, macs in self.seen_macs.items():
             output += "Source %d:\n" % src
             for mac in macs:
-                output += " - %s\n" % mac
+                output += " - %s\n" % self.pretty_mac(mac)
         return output
 
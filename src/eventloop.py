@@ -0,0 +1,52 @@
+# Event loop selection
+#
+# Layers only talk to the loop through tornado's IOLoop (add_handler,
+# add_callback, add_future...), so the loop underneath can be swapped:
+#
+# - "tornado": tornado's own epoll loop (the default)
+# - "asyncio": tornado running on an asyncio event loop, which serves
+#   add_handler with loop.add_reader/add_writer. On Python 2 this needs the
+#   trollius backport. If uvloop is installed (Python 3 only) its loop is used.
+#
+# `install` must be called before anything else uses IOLoop.instance().
+
+from tornado.ioloop import IOLoop
+
+LOOPS = ("tornado", "asyncio")
+
+def install(name="tornado"):
+    if name == "tornado":
+        pass
+    elif name == "asyncio":
+        try:
+            from tornado.platform.asyncio import AsyncIOMainLoop, asyncio
+        except ImportError:
+            raise Exception("The asyncio loop needs asyncio (or trollius, on Python 2)")
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        AsyncIOMainLoop().install()
+    else:
+        raise Exception("Unknown event loop '{}'".format(name))
+    return IOLoop.instance()
+
+def reset_after_fork(name="tornado"):
+    # Give a forked child a loop of its own. The parent's loop is abandoned
+    # rather than closed: its epoll instance is shared with the parent, so
+    # closing it would unregister the parent's handlers.
+    IOLoop.clear_instance()
+    if name == "asyncio":
+        from tornado.platform.asyncio import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    return install(name)
+
+def describe(io_loop=None):
+    # Human-readable name of the loop in use
+    io_loop = io_loop or IOLoop.instance()
+    asyncio_loop = getattr(io_loop, "asyncio_loop", None)
+    if asyncio_loop is not None:
+        return "asyncio ({})".format(type(asyncio_loop).__module__)
+    return "tornado ({})".format(type(io_loop).__name__)
@@ -0,0 +1,25 @@
+#!/usr/bin/python2
+
+import base
+import ethernet 
+import ip
+import tcp
+import udp
+import util
+
+eth_layer = ethernet.EthernetLayer()
+root.register_child(eth_layer)
+
+ipv4_layer = ip.IPv4Layer()
+eth_layer.register_child(ipv4_layer)
+
+udp_layer = udp.UDPLayer()
+ipv4_layer.register_child(udp_layer)
+
+tcp_layer = tcp.TCPLayer()
+ipv4_layer.register_child(tcp_layer)
+
+# Terminate & re-originate connections to port 5001 without touching the data
+proxy_filter_layer = tcp.TCPFilterLayer(5001)
+proxy_filter_layer.name = "proxy_port_filter"
+tcp_layer.register_child(proxy_filter_layer)
@@ -1,34 +1,165 @@
+import collections
+import traceback
 import zlib
 
 from base import NetLayer
 from util import MultiOrderedDict, PipeLayer
 from tornado import gen, httputil
 
-def zlib_compress(data, wbits):
-    cobj = zlib.compressobj(9, zlib.DEFLATED, wbits)
-    return cobj.compress(data) + cobj.flush()
+class ChunkedDecoder(object):
+    # Incremental decoder for chunked transfer-coding (RFC 7230 section 4.1)
+    # `feed` returns the body data in what it's given. Once the last chunk
+    # and the trailer have been read, `done` is set and `leftover` holds
+    # whatever came after them. Trailer fields are dropped.
+    SIZE, DATA, DATA_END, TRAILER = range(4)
+    MAX_LINE = 4096
+
+    def __init__(self):
+        self.state = self.SIZE
+        self.remaining = 0
+        self.line = ""
+        self.done = False
+        self.error = None
+        self.leftover = ""
+
+    def feed(self, data):
+        body = []
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self.state == self.DATA:
+                piece = data[pos:pos + self.remaining]
+                body.append(piece)
+                pos += len(piece)
+                self.remaining -= len(piece)
+                if not self.remaining:
+                    self.state = self.DATA_END
+                continue
+
+            end = data.find("\n", pos)
+            if end < 0:
+                self.line += data[pos:]
+                pos = len(data)
+                if len(self.line) > self.MAX_LINE:
+                    self.fail("Chunk line too long")
+                break
+            line = (self.line + data[pos:end]).strip()
+            self.line = ""
+            pos = end + 1
+
+            if self.state == self.SIZE:
+                try:
+                    size = int(line.split(";", 1)[0], 16)
+                except ValueError:
+                    self.fail("Bad chunk size '{}'".format(line))
+                    break
+                if size:
+                    self.remaining = size
+                    self.state = self.DATA
+                else:
+                    self.state = self.TRAILER
+            elif self.state == self.DATA_END:
+                self.state = self.SIZE
+            elif not line:
+                self.done = True
+
+        if self.done:
+            self.leftover = data[pos:]
+        return "".join(body)
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+
+class ContentDecoder(object):
+    # Incremental decoder for a zlib-based content-coding, trying each of
+    # the window bits in `options` in turn until one works.
+    # `feed` returns the decoded data in what it's given, and is given None
+    # at the end of the body. Until some output has come out, the input is
+    # kept in `raw`, so that if no option works (`error` is set before
+    # `started`) the body can still be sent on as it came.
+    def __init__(self, options):
+        self.options = list(options)
+        self.wbits = self.options.pop(0)
+        self.decompressor = zlib.decompressobj(self.wbits)
+        self.raw = []
+        self.started = False
+        self.error = None
+
+    def feed(self, data):
+        if self.error is not None:
+            return ""
+        if not self.started and data is not None:
+            self.raw.append(data)
+        try:
+            output = self.decompress(self.decompressor, data)
+        except zlib.error as e:
+            output = None
+            if not self.started:
+                output = self.retry(data is None)
+            if output is None:
+                self.error = e
+                return ""
+        if output:
+            self.started = True
+            self.raw = []
+        return output
+
+    def retry(self, end):
+        # Decode everything so far with the next option that can
+        raw = "".join(self.raw)
+        while self.options:
+            self.wbits = self.options.pop(0)
+            self.decompressor = zlib.decompressobj(self.wbits)
+            try:
+                output = self.decompressor.decompress(raw)
+                if end:
+                    output += self.decompressor.flush()
+                return output
+            except zlib.error:
+                pass
+        return None
+
+    @staticmethod
+    def decompress(decompressor, data):
+        if data is None:
+            return decompressor.flush()
+        return decompressor.decompress(data)
 
 class HTTPLayer(NetLayer):
     NAME = "http"
 
-    ENCODERS = {
-        "gzip": lambda x: zlib_compress(x, 16 | zlib.MAX_WBITS),
-        "deflate": lambda x: zlib_compress(x, -zlib.MAX_WBITS),
-        "zlib": lambda x: zlib_compress(x, zlib.MAX_WBITS),
-        "identity": lambda x: x,
-    }
-
-    DECODERS = {
-        "gzip": lambda x: zlib.decompress(x, 16 | zlib.MAX_WBITS),
-        "deflate": lambda x: zlib.decompress(x, -zlib.MAX_WBITS),
-        "zlib": lambda x: zlib.decompress(x, zlib.MAX_WBITS),
-        "identity": lambda x: x,
+    # Content-codings we can decode & encode, and the zlib window bits to
+    # try decoding them with. The first is used to encode.
+    # "deflate" is meant to be zlib-wrapped, but often isn't.
+    CODINGS = {
+        "gzip": (16 | zlib.MAX_WBITS,),
+        "deflate": (-zlib.MAX_WBITS, zlib.MAX_WBITS),
+        "zlib": (zlib.MAX_WBITS,),
+        "identity": (),
     }
+    # zlib level used to re-encode bodies that were decoded; 9 costs a lot
+    # more CPU for very little gain on typical pages
+    COMPRESS_LEVEL = 6
 
     CONN_ID_KEY = "tcp_conn"
 
+    # How a body that's passed on as it arrives is framed on the way out:
+    # RAW keeps the message's own framing, which only works if the body's
+    # length can't change (no child layer) or it runs until the connection
+    # closes. CHUNKED re-frames it with chunked transfer-coding.
+    STREAM_RAW = "raw"
+    STREAM_CHUNKED = "chunked"
+
+    # Headers `format_head` removes: messages carrying them can't be passed
+    # on as they came, even if no child layer wants them
+    STRIPPED_HEADERS = ("if-none-match", "if-modified-since", "etag", "upgrade")
+
     def __init__(self, *args, **kwargs):
         self.ports = kwargs.pop("ports", {})
+        self.compress_level = kwargs.pop("compress_level", self.COMPRESS_LEVEL)
+        # If False, decoded bodies are sent on with the identity coding
+        # (and no Content-Encoding header) instead of being re-encoded
+        self.recompress = kwargs.pop("recompress", True)
         self.connections = {}
 
         super(HTTPLayer, self).__init__(*args, **kwargs)
@@ -38,9 +169,11 @@ class HTTPLayer(NetLayer):
         conn_id = conn[self.CONN_ID_KEY]
         if conn_id not in self.connections:
             dst = self.route(src, conn)
-            req = self.request(conn, dst, src)
+            # (method, version) of the requests waiting for a response
+            requests = collections.deque()
+            req = self.request(conn, dst, src, requests)
             req.next()
-            resp = self.response(conn, src, dst)
+            resp = self.response(conn, src, dst, requests)
             resp.next()
             self.connections[conn_id] = {src: req, dst: resp}
 
@@ -61,31 +194,58 @@ class HTTPLayer(NetLayer):
             name, value = line.split(":", 1)
             hdict.push(name, value.strip())
 
-    def request(self, conn, src, dst):
+    def request(self, conn, src, dst, requests):
+        return self.messages(conn, src, dst, requests, True)
+
+    def response(self, conn, src, dst, requests):
+        return self.messages(conn, src, dst, requests, False)
+
+    def messages(self, conn, src, dst, requests, is_request):
+        # Generator parsing the messages going one way on a connection,
+        # sent lines (then raw data, once it has turned line buffering off)
+        # and None when the connection closes. Data past the end of a body
+        # is handed back to the LineBufferLayer.
+        # A message's body is bubbled up either whole, once it has all
+        # arrived, or -- if the child layer it goes to is STREAMING -- a
+        # piece at a time as it arrives, followed by None.
+        # Everything is sent on through `send`, so each piece (and each
+        # message) waits for the one before it, and every message gets its
+        # own copy of `conn` which is left alone once it's been parsed.
         keep_alive = True
-        req = None
-        conn = conn.copy()
+        send = self.sequencer()
+        base_conn = conn.copy()
+        if is_request:
+            parse_start_line = httputil.parse_request_start_line
+            start_key = "http_request"
+        else:
+            parse_start_line = httputil.parse_response_start_line
+            start_key = "http_response"
 
-        req_line = yield 
-        while keep_alive and req_line is not None:
-            body = ""
+        start_line = yield 
+        while keep_alive and start_line is not None:
             headers = MultiOrderedDict()
             try:
-                req = httputil.parse_request_start_line(req_line.strip())
+                start = parse_start_line(start_line.strip())
             except httputil.HTTPInputError:
-                if req_line != "":
-                    self.log("HTTP Error: Malformed request start line: '{}'", req_line)
-                req_line = yield
+                if start_line != "":
+                    self.log("HTTP Error: Malformed {} start line: '{}'", "request" if is_request else "response", start_line)
+                start_line = yield
                 continue
+            # The head as it arrived, to send on if nothing will change it
+            raw_head = [start_line]
             while True:
                 header_line = yield
                 if header_line is None:
+                    if not is_request:
+                        self.log("HTTP Warning: Terminated early?")
+                        return
                     break
+                raw_head.append(header_line)
                 if not header_line.strip():
                     break
                 self.parse_header_line(headers, header_line.strip())
 
-            if req.version == "HTTP/1.0":
+            if start.version == "HTTP/1.0":
                 keep_alive = headers.last("connection", "").lower().strip() == "keep-alive"
             else:
                 keep_alive = headers.last("connection", "").lower().strip() != "close"
@@ -97,106 +257,274 @@ class HTTPLayer(NetLayer):
                     content_length = None
             else:
                 content_length = None
-
-            if req.method != "POST":
-                content_length = content_length or 0
-
-            
-            if header_line is not None:
-                #body += conn["lbl_buffers"][dst]
-                #conn["lbl_buffers"][dst] = ""
-                conn["lbl_disable"](dst)
-                while len(body) < content_length or content_length is None:
-                    data = yield
-                    if data is None:
-                        break
-                    body += data
-
-            if "content-encoding" in headers:
-                conn["http_decoded"] = False
-                encoding = headers.last("content-encoding")
-                self.log("req encoding: {}", encoding)
-                if encoding in self.DECODERS:
-                    try:
-                        body = self.DECODERS[encoding](body)
-                        conn["http_decoded"] = True
-                    except:
-                        self.log("Unable to decode content '{}' len={}/{}", encoding, len(body), content_length)
+            # Chunked transfer-coding overrides any Content-Length
+            chunked = headers.last("transfer-encoding", "").split(",")[-1].strip().lower() == "chunked"
+
+            if is_request:
+                if start.method != "POST":
+                    content_length = content_length or 0
+                requests.append((start.method, start.version))
+                chunked_ok = False
             else:
-                conn["http_decoded"] = True
-
-            conn["lbl_enable"](dst)
+                if 100 <= start.code < 200:
+                    # An interim response: the real one follows
+                    method, request_version = requests[0] if requests else ("GET", "HTTP/1.1")
+                else:
+                    method, request_version = requests.popleft() if requests else ("GET", "HTTP/1.1")
+                if method == "HEAD" or 100 <= start.code < 200 or start.code in (204, 304):
+                    content_length = 0
+                    chunked = False
+                # Only send chunked bodies to clients that understand them
+                chunked_ok = start.version == request_version == "HTTP/1.1"
+
+            conn = base_conn.copy()
             conn["http_headers"] = headers
-            conn["http_request"] = req
-            req_line = yield self.bubble(dst, conn, body)
+            conn[start_key] = start
+            conn["http_stream"] = None
+            # Window bits to re-encode the body with, once it's been decoded
+            conn["http_wbits"] = None
 
-    def response(self, conn, src, dst):
-        keep_alive = True
-        resp = None
-        conn = conn.copy()
+            # Whether the message can be sent on byte for byte, if no child
+            # wants it
+            passthrough = header_line is not None and not any(name in headers for name in self.STRIPPED_HEADERS)
 
-        start_line = yield 
-        while keep_alive and start_line is not None:
-            body = ""
-            headers = MultiOrderedDict()
-            try:
-                resp = httputil.parse_response_start_line(start_line.strip())
-            except httputil.HTTPInputError:
-                if start_line != "":
-                    self.log("HTTP Error: Malformed response start line: '{}'", start_line)
+            if header_line is not None and content_length == 0 and not chunked:
+                conn["http_decoded"] = True
+                if passthrough and self.resolve_child(dst, conn) is None:
+                    send(self.write_back, self.route(dst, conn), conn, "".join(raw_head))
+                    start_line = yield
+                    continue
+                # Children get an empty body, and whatever they write back is
+                # sent without touching the head's framing (a HEAD response's
+                # Content-Length describes the body it doesn't have)
+                conn["http_stream"] = {"framing": self.STREAM_RAW, "started": False, "encoder": None, "truncated": False}
+                send(self.bubble, dst, conn, "")
                 start_line = yield
                 continue
-            while True:
-                header_line = yield
-                if header_line is None:
-                    self.log("HTTP Warning: Terminated early?")
-                    return
-                if not header_line.strip():
-                    break
-                self.parse_header_line(headers, header_line.strip())
 
-            if resp.version == "HTTP/1.0":
-                keep_alive = headers.last("connection", "").lower().strip() == "keep-alive"
+            if "content-encoding" in headers:
+                encoding = headers.last("content-encoding").strip().lower()
             else:
-                keep_alive = headers.last("connection", "").lower().strip() != "close"
-
-            if "content-length" in headers:
-                try:
-                    content_length = int(headers.last("content-length"))
-                except ValueError:
-                    content_length = None
+                encoding = "identity"
+            # Whether children will get the body decoded: they decide
+            # whether they want the message by looking at this
+            conn["http_decoded"] = encoding in self.CODINGS
+            child = self.resolve_child(dst, conn)
+            # Bodies nothing will look at are never decoded
+            decode = child is not None and bool(self.CODINGS.get(encoding))
+
+            passthrough = passthrough and child is None
+
+            framing = None
+            if passthrough:
+                # Head & body go straight back down, without being rebuilt
+                deliver = self.passthrough_deliver(dst, conn, send, "".join(raw_head))
             else:
-                content_length = None
-
+                if header_line is not None:
+                    framing = self.stream_framing(child, content_length, chunked, chunked_ok)
+                if framing is not None:
+                    stream = conn["http_stream"] = {"framing": framing, "started": False, "encoder": None, "truncated": False}
+                    if framing == self.STREAM_CHUNKED and not chunked:
+                        headers.remove("content-length")
+                        headers.push("Transfer-Encoding", "chunked")
+                    content_decoder = ContentDecoder(self.CODINGS[encoding]) if decode else None
+                    deliver = self.stream_deliver(dst, conn, send, content_decoder)
+                else:
+                    body = []
+                    deliver = body.append
 
             if header_line is not None:
                 #body += conn["lbl_buffers"][dst]
                 #conn["lbl_buffers"][dst] = ""
                 conn["lbl_disable"](dst)
-                while len(body) < content_length or content_length is None:
+                decoder = ChunkedDecoder() if chunked else None
+                received = 0
+                leftover = ""
+                while True:
                     data = yield
                     if data is None:
+                        # Closing the connection only ends bodies with
+                        # nothing else marking their end
+                        if decoder is not None or content_length is not None:
+                            self.log("HTTP Warning: Connection closed before the end of the body")
+                            if framing is not None:
+                                stream["truncated"] = True
+                        break
+                    if decoder is not None:
+                        piece = decoder.feed(data)
+                        if decoder.done:
+                            leftover = decoder.leftover
+                        if passthrough:
+                            # Keep the chunked framing as it was
+                            piece = data[:len(data) - len(leftover)]
+                        if piece:
+                            deliver(piece)
+                        if decoder.done:
+                            if decoder.error is not None:
+                                self.log("HTTP Error: {}", decoder.error)
+                                if framing is not None:
+                                    stream["truncated"] = True
+                            break
+                        continue
+                    received += len(data)
+                    if content_length is not None and received >= content_length:
+                        extra = received - content_length
+                        leftover = data[len(data) - extra:] if extra else ""
+                        deliver(data[:len(data) - extra])
                         break
-                    body += data
+                    deliver(data)
+                conn["lbl_unread"](dst, leftover)
+                conn["lbl_enable"](dst)
 
-            if "content-encoding" in headers:
-                conn["http_decoded"] = False
-                encoding = headers.last("content-encoding")
-                self.log("req encoding: {}", encoding)
-                if encoding in self.DECODERS:
-                    try:
-                        body = self.DECODERS[encoding](body)
-                        conn["http_decoded"] = True
-                    except:
-                        self.log("Unable to decode content '{}' len={}/{}", encoding, len(body), content_length)
-            else:
-                # Technically it was decoded with the 'identity' encoding...
-                conn["http_decoded"] = True
+            if passthrough:
+                deliver(None)
+                start_line = yield
+                continue
+
+            if framing is not None:
+                deliver(None)
+                send(self.bubble, dst, conn, None)
+                start_line = yield
+                continue
+
+            body = "".join(body)
+            if chunked:
+                # Sent on with a Content-Length instead
+                headers.remove("transfer-encoding")
+                headers.remove("content-length")
+                headers.push("Content-Length", str(len(body)))
+
+            if decode:
+                content_decoder = ContentDecoder(self.CODINGS[encoding])
+                decoded = content_decoder.feed(body) + content_decoder.feed(None)
+                if content_decoder.error is None:
+                    body = decoded
+                    self.decoded(conn, content_decoder.wbits)
+                else:
+                    conn["http_decoded"] = False
+                    self.log("Unable to decode content '{}' len={}/{}", encoding, len(body), content_length)
 
             conn["lbl_enable"](dst)
-            conn["http_headers"] = headers
-            conn["http_response"] = resp
-            start_line = yield self.bubble(dst, conn, body)
+            send(self.bubble, dst, conn, body)
+            start_line = yield
+
+    def sequencer(self):
+        # Function making coroutine calls one after another: `send(fn, *args)`
+        # calls `fn(*args)` once the future returned by the call before it
+        # is done
+        queue = collections.deque()
+        def step():
+            while queue:
+                fn, args = queue[0]
+                try:
+                    future = fn(*args)
+                except Exception:
+                    traceback.print_exc()
+                    future = None
+                if future is not None and not future.done():
+                    future.add_done_callback(done)
+                    return
+                done(future, next_step=False)
+        def done(future, next_step=True):
+            self.add_future(future)
+            queue.popleft()
+            if next_step:
+                step()
+        def send(fn, *args):
+            queue.append((fn, args))
+            if len(queue) == 1:
+                step()
+        return send
+
+    def stream_deliver(self, dst, conn, send, content_decoder=None):
+        # Function passing pieces of a streamed body up, decoding them with
+        # `content_decoder` if given. Called with None at the end of the body.
+        # Nothing goes up until the decoder has produced something (or the
+        # body has ended), so a body that doesn't decode is sent on as it
+        # came instead.
+        committed = []
+        def deliver(piece):
+            if content_decoder is not None and content_decoder.error is None:
+                output = content_decoder.feed(piece)
+                if content_decoder.error is None:
+                    if (output or piece is None) and not committed:
+                        committed.append(True)
+                        self.decoded(conn, content_decoder.wbits)
+                    piece = output
+                elif committed:
+                    # Can't take back what's been sent, so drop the rest
+                    self.log("Unable to decode content: {}", content_decoder.error)
+                    return
+                else:
+                    self.log("Unable to decode content, sending it on encoded: {}", content_decoder.error)
+                    conn["http_decoded"] = False
+                    piece = "".join(content_decoder.raw)
+            elif committed and content_decoder.error is not None:
+                return
+            if piece:
+                send(self.bubble, dst, conn, piece)
+        return deliver
+
+    def decoded(self, conn, wbits):
+        # The body of the message in `conn` has been decoded with `wbits`:
+        # have it re-encoded the same way on its way out, or sent on without
+        # a content-coding
+        stream = conn["http_stream"]
+        if not self.recompress:
+            conn["http_headers"].remove("content-encoding")
+        elif stream is not None:
+            stream["encoder"] = self.compressor(wbits)
+        else:
+            conn["http_wbits"] = wbits
+
+    def passthrough_deliver(self, dst, conn, send, head):
+        # Function writing a message's body back down as it arrived, after
+        # its head `head`. Called with None at the end of the body.
+        port = self.route(dst, conn)
+        pending = [head]
+        def deliver(data):
+            if pending:
+                # Sent with the first piece of the body, not on its own
+                data = pending.pop() + (data or "")
+            if data:
+                send(self.write_back, port, conn, data)
+        return deliver
+
+    def stream_framing(self, child, content_length, chunked, chunked_ok):
+        # How to pass a body going to `child` on as it arrives, or None if
+        # it has to be buffered
+        streaming = child is None or getattr(child, "STREAMING", False)
+        if not streaming:
+            return None
+        if chunked:
+            # The body is decoded as it arrives, so it has to be re-encoded
+            return self.STREAM_CHUNKED
+        if child is None or content_length is None:
+            # Either nothing will touch the body, or its end is marked by
+            # closing the connection
+            return self.STREAM_RAW
+        if chunked_ok:
+            return self.STREAM_CHUNKED
+        return None
+
+    def compressor(self, wbits):
+        return zlib.compressobj(self.compress_level, zlib.DEFLATED, wbits)
+
+    def do_compression(self, *args):
+        """compression [<level>|identity|recompress] - Show or set how decoded bodies are re-encoded."""
+        if args:
+            if args[0] == "identity":
+                self.recompress = False
+            elif args[0] == "recompress":
+                self.recompress = True
+            else:
+                level = int(args[0])
+                if not 0 <= level <= 9:
+                    raise Exception("Compression level must be 0-9")
+                self.compress_level = level
+        if not self.recompress:
+            return "Compression: off, decoded bodies are sent with the identity coding"
+        return "Compression: level {}".format(self.compress_level)
 
     @gen.coroutine
     def on_close(self, src, conn):
@@ -205,8 +533,9 @@ class HTTPLayer(NetLayer):
             self.connections[conn_id][src].send(None)
         yield self.close_bubble(src, conn)
 
-    @gen.coroutine
-    def write(self, dst, conn, data):
+    def format_head(self, conn, length=None):
+        # Start line & headers of the message in `conn`, with the
+        # Content-Length (if there is one) set to `length`
         if "http_request" in conn:
             start_line = "{0.method} {0.path} {0.version}\r\n".format(conn["http_request"])
         elif "http_response" in conn:
@@ -215,16 +544,10 @@ class HTTPLayer(NetLayer):
             raise Exception("No start line for HTTP")
 
         output = start_line
-        #yield self.write_back(dst, conn, start_line)
 
         headers = conn["http_headers"]
-        if "content-encoding" in headers and conn["http_decoded"]:
-            encoding = headers.last("content-encoding")
-            if encoding in self.ENCODERS:
-                data = self.ENCODERS[encoding](data)
-
-        if "content-length" in headers:
-            headers.set("Content-Length", str(len(data)))
+        if "content-length" in headers and length is not None:
+            headers.set("Content-Length", str(length))
 
         # Remove caching headers
         headers.remove("if-none-match")
@@ -238,14 +561,42 @@ class HTTPLayer(NetLayer):
             multiline_value = value.replace("\n", "\n ")
             line = "{}: {}\r\n".format(key, multiline_value)
             output += line
-            #yield self.write_back(dst, conn, line)
 
         self.log(">> {}", output)
+        return output + "\r\n"
 
-        #yield self.write_back(dst, conn, "\r\n")
-        #yield self.write_back(dst, conn, data)
+    @gen.coroutine
+    def write(self, dst, conn, data):
+        stream = conn.get("http_stream")
+        if stream is not None:
+            # A piece of a streamed body, or None at its end
+            output = ""
+            if not stream["started"]:
+                stream["started"] = True
+                output = self.format_head(conn)
+            end = data is None
+            encoder = stream["encoder"]
+            if encoder is not None:
+                data = encoder.flush() if end else encoder.compress(data)
+            if stream["framing"] == self.STREAM_CHUNKED:
+                if data:
+                    output += "{:x}\r\n{}\r\n".format(len(data), data)
+                if end and not stream["truncated"]:
+                    # Left off if the body was cut short, so what's been
+                    # sent isn't taken for all of it
+                    output += "0\r\n\r\n"
+            elif data:
+                output += data
+            if output:
+                yield self.write_back(dst, conn, output)
+            return
+
+        headers = conn["http_headers"]
+        if conn.get("http_wbits") is not None:
+            encoder = self.compressor(conn["http_wbits"])
+            data = encoder.compress(data) + encoder.flush()
 
-        output += "\r\n"
+        output = self.format_head(conn, len(data))
         output += data
         yield self.write_back(dst, conn, output)
         #yield self.write_back(dst, conn, None)
@@ -262,6 +613,10 @@ class ImageFlipLayer(PipeLayer):
 
 class XSSInjectorLayer(NetLayer):
     NAME = "xss"
+    # Takes HTTP bodies a piece at a time, see HTTPLayer
+    STREAMING = True
+    SCRIPT = "\nalert('xss');\n"
+
     def match(self, src, header):
         if "http_headers" not in header:
             return False
@@ -269,25 +624,66 @@ class XSSInjectorLayer(NetLayer):
 
     @gen.coroutine
     def write(self, dst, header, payload):
-        output = payload + "\nalert('xss');\n"
-        yield self.write_back(dst, header, output)
+        if payload is None:
+            # End of a streamed body
+            yield self.write_back(dst, header, self.SCRIPT)
+        elif header.get("http_stream") is None:
+            payload += self.SCRIPT
+        yield self.write_back(dst, header, payload)
 
 class CloudToButtLayer(NetLayer):
     NAME = "cloud2butt"
+    # Takes HTTP bodies a piece at a time, see HTTPLayer
+    STREAMING = True
+    REPLACEMENTS = [
+        ("the cloud", "my butt"),
+        ("the Cloud", "my Butt"),
+        ("The Cloud", "My Butt"),
+        ("The cloud", "My butt"),
+        ("cloud", "butt"),
+        ("Cloud", "Butt"),
+    ]
+    # The end of a piece that's held back until the next one arrives, in
+    # case a match is split between them
+    CARRY = max(len(old) for old, new in REPLACEMENTS) - 1
+
     def match(self, src, header):
         if "http_headers" not in header:
             return False
         return header["http_decoded"] and "text" in header["http_headers"].last("content-type", "")
 
-    # coroutine
-    def write(self, dst, header, payload):
-        self.log("Performing replacement on {} bytes", len(payload))
-        butt_data = payload
-        butt_data = butt_data.replace("the cloud", "my butt")
-        butt_data = butt_data.replace("the Cloud", "my Butt")
-        butt_data = butt_data.replace("The Cloud", "My Butt")
-        butt_data = butt_data.replace("The cloud", "My butt")
-        butt_data = butt_data.replace("cloud", "butt")
-        butt_data = butt_data.replace("Cloud", "Butt")
-        return self.write_back(dst, header, butt_data)
+    def replace(self, data):
+        for old, new in self.REPLACEMENTS:
+            data = data.replace(old, new)
+        return data
+
+    def split(self, data):
+        # Split `data` where no match can be cut in two, leaving at most
+        # CARRY bytes after the split
+        cut = max(0, len(data) - self.CARRY)
+        moved = True
+        while moved:
+            moved = False
+            for old, new in self.REPLACEMENTS:
+                start = data.find(old, max(0, cut - len(old) + 1))
+                if 0 <= start < cut:
+                    cut = start
+                    moved = True
+        return data[:cut], data[cut:]
 
+    @gen.coroutine
+    def write(self, dst, header, payload):
+        if header.get("http_stream") is None:
+            self.log("Performing replacement on {} bytes", len(payload))
+            yield self.write_back(dst, header, self.replace(payload))
+            return
+
+        carry = header.get("c2b_carry", "")
+        if payload is None:
+            header["c2b_carry"] = ""
+            if carry:
+                yield self.write_back(dst, header, self.replace(carry))
+            yield self.write_back(dst, header, None)
+            return
+        data, header["c2b_carry"] = self.split(carry + payload)
+        yield self.write_back(dst, header, self.replace(data))
@@ -1,8 +1,11 @@
 import collections
 import dpkt
 import random
+import struct
 
+import base
 from base import NetLayer
+from checksum import cksum_add, cksum_done, cksum_update, pseudo_header_sum
 
 import tornado.gen as gen
 
@@ -28,39 +31,93 @@ import tornado.gen as gen
 #        setattr(self, list_name, list_obj)
 #    return do_add, do_rm
 
+class IPHeaderTemplate(object):
+    # Precompiled IPv4 header for packets forged between one pair of hosts
+    # Only the length, id and checksum change from packet to packet; the
+    # header checksum is patched from the template's (RFC 1624) and the
+    # TCP/UDP pseudo-header sum is computed once.
+    __slots__ = ("p", "head", "tail", "addrs", "cksum", "pseudo_sum")
+
+    HEADER = struct.Struct("!BBHHHBBH4s4s")
+    LENGTH_ID = struct.Struct("!HH")
+    CKSUM = struct.Struct("!H")
+    TTL = 64
+    # Where the checksum lives in TCP/UDP segments
+    L4_CKSUM_OFFSETS = {
+        dpkt.ip.IP_PROTO_TCP: 16,
+        dpkt.ip.IP_PROTO_UDP: 6,
+    }
+
+    def __init__(self, src, dst, p):
+        self.p = p
+        header = self.HEADER.pack(0x45, 0, 0, 0, 0, self.TTL, p, 0, src, dst)
+        self.head = header[:2]
+        self.tail = header[6:10]
+        self.addrs = header[12:]
+        self.cksum = cksum_done(cksum_add(header))
+        self.pseudo_sum = pseudo_header_sum(src, dst, p)
+
+    def build(self, ip_id, payload):
+        # `payload` is a string, or a dpkt TCP/UDP packet whose checksum
+        # should be filled in if it is zero
+        if isinstance(payload, dpkt.Packet):
+            segment = str(payload)
+            offset = self.L4_CKSUM_OFFSETS.get(self.p)
+            if offset is not None and payload.sum == 0:
+                l4_cksum = cksum_done(cksum_add(segment, self.pseudo_sum + len(segment)))
+                if l4_cksum == 0 and self.p == dpkt.ip.IP_PROTO_UDP:
+                    l4_cksum = 0xFFFF # RFC 768
+                segment = segment[:offset] + self.CKSUM.pack(l4_cksum) + segment[offset + 2:]
+        else:
+            segment = payload
+
+        length = 20 + len(segment)
+        cksum = cksum_update(cksum_update(self.cksum, 0, length), 0, ip_id)
+        return "".join((self.head, self.LENGTH_ID.pack(length, ip_id), self.tail,
+                        self.CKSUM.pack(cksum), self.addrs, segment))
+
 class IPv4Layer(NetLayer):
     NAME = "ip"
 
-    @staticmethod
-    def pretty_ip(ip):
-        return ".".join([str(ord(x)) for x in ip])
-    @staticmethod
-    def wire_ip(ip):
-        return "".join([chr(int(x)) for x in ip.split(".")])
+    pretty_ip = staticmethod(base.pretty_ip)
+    wire_ip = staticmethod(base.wire_ip)
+
+    # Maximum number of host pairs to keep header templates for
+    TEMPLATE_CACHE_MAX = 4096
 
     def __init__(self):
         self.next_ids = {}
+        self.templates = {}
         self.seen_ips = collections.defaultdict(set)
         self.protocol_stats = collections.Counter()
 
         super(IPv4Layer, self).__init__()
 
+    DISPATCH_KEY = "eth_type"
+
     def match(self, src, header):
         return header["eth_type"] == dpkt.ethernet.ETH_TYPE_IP
 
+    def dispatch_values(self):
+        return (dpkt.ethernet.ETH_TYPE_IP,)
+
+    @staticmethod
+    def dispatch_lookup(header):
+        return (header["eth_type"],)
+
     # coroutine
     def on_read(self, src, header, payload):
         # It already comes parsed by dpkt from EthernetLayer
         #pkt = dpkt.ip.IP(payload) 
         #print "IP>", payload
         pkt = payload 
-        header["ip_id"] = pkt.id
-        header["ip_dst"] = dst_ip = self.pretty_ip(pkt.dst)
-        header["ip_src"] = src_ip = self.pretty_ip(pkt.src)
-        header["ip_p"] = pkt.p
+        header.ip_id = pkt.id
+        header.ip_dst = pkt.dst
+        header.ip_src = pkt.src
+        header.ip_p = pkt.p
 
-        self.seen_ips[src_ip].add(header["eth_src"])
-        self.seen_ips[dst_ip].add(header["eth_dst"])
+        self.seen_ips[pkt.src].add(header.eth_src)
+        self.seen_ips[pkt.dst].add(header.eth_dst)
 
         self.protocol_stats[pkt.p] += 1
 
@@ -74,17 +131,17 @@ class IPv4Layer(NetLayer):
             # Generate one randomly if we need to
             self.next_ids[src_mac] = header.get("ip_id", random.randint(0, 0xFFFF))
 
-        pkt = dpkt.ip.IP(
-                id=self.next_ids[src_mac],
-                dst=self.wire_ip(header["ip_dst"]),
-                src=self.wire_ip(header["ip_src"]),
-                p=header["ip_p"])
+        ip_id = self.next_ids[src_mac]
+        self.next_ids[src_mac] = (ip_id + 1) & 0xFFFF
 
-        self.next_ids[src_mac] = (self.next_ids[src_mac] + 1) & 0xFFFF
-        pkt.data = payload
-        pkt.len += len(payload)
+        key = (header["ip_src"], header["ip_dst"], header["ip_p"])
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= self.TEMPLATE_CACHE_MAX:
+                self.templates.clear()
+            template = self.templates[key] = IPHeaderTemplate(*key)
 
-        return self.write_back(dst, header, str(pkt))
+        return self.write_back(dst, header, template.build(ip_id, payload))
     
     def do_protos(self):
         """List statistics about protocols."""
@@ -106,5 +163,15 @@ class IPv4FilterLayer(NetLayer):
             ips = []
         self.ips = ips
 
+    @property
+    def ips(self):
+        return self._ips
+
+    @ips.setter
+    def ips(self, ips):
+        # Configured as dotted strings, matched against wire-form addresses
+        self._ips = ips
+        self.wire_ips = frozenset(IPv4Layer.wire_ip(ip) for ip in ips)
+
     def match(self, src, header):
-        return header["ip_src"] in self.ips  or header["ip_dst"] in self.ips
+        return header["ip_src"] in self.wire_ips or header["ip_dst"] in self.wire_ips
@@ -1,30 +1,381 @@
 # For Linux
 
+import collections
+import errno
+import mmap
 import socket
+import struct
 import subprocess
+import traceback
 
+from tornado import gen
 from tornado.ioloop import IOLoop
-from tornado.iostream import IOStream
 
-from base import NetLayer
+from base import DONE, NetLayer, wire_mac
+from capture import CaptureWriter, read_capture
+
+def flow_key(proto, ip_a, port_a, ip_b, port_b):
+    # Direction-independent key for a TCP/UDP flow, with addresses in wire form
+    a = (ip_a, port_a)
+    b = (ip_b, port_b)
+    if b < a:
+        a, b = b, a
+    return (proto, a, b)
+
+def frame_flow_key(frame):
+    # flow_key() of a raw Ethernet frame, or None if it isn't an
+    # unfragmented IPv4 TCP/UDP packet
+    if len(frame) < 38 or frame[12:14] != "\x08\x00":
+        return None
+    vhl, frag, proto = struct.unpack_from("!B5xHxB", frame, 14)
+    if vhl >> 4 != 4 or frag & 0x3FFF or proto not in (6, 17):
+        return None
+    l4 = 14 + ((vhl & 0xF) << 2)
+    if len(frame) < l4 + 4:
+        return None
+    sport, dport = struct.unpack_from("!HH", frame, l4)
+    return flow_key(proto, frame[26:30], sport, frame[30:34], dport)
+
+class PacketRing(object):
+    # TPACKET_V3 memory-mapped RX ring (and TX ring, if the kernel supports it)
+    # set up on an AF_PACKET socket. See linux/Documentation/networking/packet_mmap.txt
+    SOL_PACKET = 263
+    PACKET_RX_RING = 5
+    PACKET_VERSION = 10
+    PACKET_TX_RING = 13
+    TPACKET_V3 = 2
+
+    TP_STATUS_KERNEL = 0
+    TP_STATUS_USER = 1
+    TP_STATUS_AVAILABLE = 0
+    TP_STATUS_SEND_REQUEST = 1
+    TP_STATUS_WRONG_FORMAT = 4
+
+    # struct tpacket_req3
+    REQ = struct.Struct("IIIIIII")
+    # struct tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+    BLOCK_HDR = struct.Struct("III")
+    BLOCK_HDR_OFFSET = 8
+    # struct tpacket3_hdr: tp_next_offset ... tp_status, tp_mac
+    FRAME_HDR = struct.Struct("IIIIIIH")
+    FRAME_STATUS_OFFSET = 20
+    # TPACKET3_HDRLEN - sizeof(struct sockaddr_ll)
+    TX_DATA_OFFSET = 48
+
+    BLOCK_SIZE = 1 << 18
+    RX_BLOCKS = 64
+    TX_BLOCKS = 4
+    FRAME_SIZE = 2048
+    RETIRE_TIMEOUT_MS = 10
+
+    def __init__(self, sock, tx=True):
+        self.sock = sock
+        self.tx_frames = 0
+        self.tx_dropped = 0
+        self.tx_pending = False
+
+        sock.setsockopt(self.SOL_PACKET, self.PACKET_VERSION, self.TPACKET_V3)
+
+        frames_per_block = self.BLOCK_SIZE // self.FRAME_SIZE
+        sock.setsockopt(self.SOL_PACKET, self.PACKET_RX_RING, self.REQ.pack(
+            self.BLOCK_SIZE, self.RX_BLOCKS, self.FRAME_SIZE, frames_per_block * self.RX_BLOCKS,
+            self.RETIRE_TIMEOUT_MS, 0, 0))
+        rx_size = self.BLOCK_SIZE * self.RX_BLOCKS
+
+        tx_size = 0
+        if tx:
+            try:
+                sock.setsockopt(self.SOL_PACKET, self.PACKET_TX_RING, self.REQ.pack(
+                    self.BLOCK_SIZE, self.TX_BLOCKS, self.FRAME_SIZE, frames_per_block * self.TX_BLOCKS,
+                    0, 0, 0))
+                tx_size = self.BLOCK_SIZE * self.TX_BLOCKS
+                self.tx_frames = frames_per_block * self.TX_BLOCKS
+            except socket.error:
+                # TX_RING with TPACKET_V3 needs Linux >= 4.11
+                pass
+
+        self.map = mmap.mmap(sock.fileno(), rx_size + tx_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.rx_block = 0
+        self.tx_base = rx_size
+        self.tx_frame = 0
+
+    @property
+    def has_tx(self):
+        return self.tx_frames > 0
+
+    def drain(self, handler):
+        # Call `handler(frame)` for every frame in the blocks the kernel has
+        # handed to us, then give each block back to the kernel.
+        # Frames are read-only `buffer` slices of the ring, and are only
+        # valid until `handler` returns: anything kept longer must be copied.
+        m = self.map
+        count = 0
+        while True:
+            block = self.rx_block * self.BLOCK_SIZE
+            status, num_pkts, offset = self.BLOCK_HDR.unpack_from(m, block + self.BLOCK_HDR_OFFSET)
+            if not status & self.TP_STATUS_USER:
+                break
+            frame = block + offset
+            try:
+                for i in xrange(num_pkts):
+                    next_offset, _sec, _nsec, snaplen, _len, _status, mac = self.FRAME_HDR.unpack_from(m, frame)
+                    handler(buffer(m, frame + mac, snaplen - 2))
+                    frame += next_offset
+            finally:
+                # Give the block back even if `handler` raised, or the ring stalls
+                struct.pack_into("I", m, block + self.BLOCK_HDR_OFFSET, self.TP_STATUS_KERNEL)
+                self.rx_block = (self.rx_block + 1) % self.RX_BLOCKS
+            count += num_pkts
+        return count
+
+    def send(self, data):
+        # Copy `data` into the next free TX frame; the kernel is kicked once
+        # per IOLoop iteration rather than once per frame
+        if len(data) > self.FRAME_SIZE - self.TX_DATA_OFFSET:
+            self.tx_dropped += 1
+            return
+        m = self.map
+        frame = self.tx_base + self.tx_frame * self.FRAME_SIZE
+        status, = struct.unpack_from("I", m, frame + self.FRAME_STATUS_OFFSET)
+        if status not in (self.TP_STATUS_AVAILABLE, self.TP_STATUS_WRONG_FORMAT):
+            # Ring is full; push out what's queued and try once more
+            self.flush()
+            status, = struct.unpack_from("I", m, frame + self.FRAME_STATUS_OFFSET)
+            if status not in (self.TP_STATUS_AVAILABLE, self.TP_STATUS_WRONG_FORMAT):
+                self.tx_dropped += 1
+                return
+        start = frame + self.TX_DATA_OFFSET
+        m[start:start + len(data)] = str(data)
+        struct.pack_into("IIIIII", m, frame, 0, 0, 0, len(data), len(data), self.TP_STATUS_SEND_REQUEST)
+        self.tx_frame = (self.tx_frame + 1) % self.tx_frames
+
+        if not self.tx_pending:
+            self.tx_pending = True
+            IOLoop.instance().add_callback(self.flush)
+
+    def flush(self):
+        self.tx_pending = False
+        try:
+            self.sock.send("", socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise
+
+    def close(self):
+        self.map.close()
+
+class OutputQueue(object):
+    # Frames waiting for a NIC's socket to accept them, bounded in bytes.
+    # Once `high` bytes are queued, the futures returned for writes stay
+    # pending until the queue has drained to `low` bytes, so layers that wait
+    # on their writes slow down. Frames that would take the queue past
+    # `limit` bytes are dropped: with the "tail" policy, the new frame; with
+    # "bypass", frames of flows nothing modifies go first, oldest first.
+    POLICIES = ("tail", "bypass")
+    BLOCKED = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+    def __init__(self, sock, limit, high, low, policy="tail"):
+        if policy not in self.POLICIES:
+            raise Exception("Unknown drop policy '{}'".format(policy))
+        self.sock = sock
+        self.limit = limit
+        self.high = high
+        self.low = low
+        self.policy = policy
+        # Entries are [frame, unmodified]; the frame is set to None once the
+        # entry has been sent or dropped
+        self.frames = collections.deque()
+        self.unmodified = collections.deque()
+        self.count = 0
+        self.size = 0
+        self.unmodified_size = 0
+        self.waiter = None
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.queued = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.errors = 0
+        self.pauses = 0
+        self.peak = self.size
+
+    def write(self, data, unmodified=False):
+        if not self.frames:
+            try:
+                self.sock.send(data)
+                self.sent += 1
+                return DONE
+            except socket.error as e:
+                if e.errno not in self.BLOCKED:
+                    self.errors += 1
+                    return DONE
+
+        if self.size + len(data) > self.limit and not self.make_room(len(data), unmodified):
+            self.dropped += 1
+            return self.waiter or DONE
+
+        entry = [data, unmodified]
+        self.frames.append(entry)
+        self.count += 1
+        self.size += len(data)
+        if unmodified:
+            self.unmodified.append(entry)
+            self.unmodified_size += len(data)
+        self.queued += 1
+        if self.size > self.peak:
+            self.peak = self.size
+        if len(self.frames) == 1:
+            IOLoop.instance().update_handler(self.sock.fileno(), IOLoop.READ | IOLoop.WRITE)
+        if self.waiter is None and self.size >= self.high:
+            self.waiter = gen.Future()
+            self.pauses += 1
+        return self.waiter or DONE
+
+    def make_room(self, size, unmodified):
+        # Drop queued frames of unmodified flows until `size` more bytes fit
+        if self.policy != "bypass" or unmodified:
+            return False
+        if self.size - self.unmodified_size + size > self.limit:
+            return False
+        while self.size + size > self.limit:
+            entry = self.unmodified.popleft()
+            if entry[0] is None:
+                continue
+            self.count -= 1
+            self.size -= len(entry[0])
+            self.unmodified_size -= len(entry[0])
+            entry[0] = None
+            self.evicted += 1
+        return True
+
+    def flush(self):
+        # Send as much as the socket will take; called when it's writable
+        frames = self.frames
+        while frames:
+            entry = frames[0]
+            data = entry[0]
+            if data is not None:
+                try:
+                    self.sock.send(data)
+                    self.sent += 1
+                except socket.error as e:
+                    if e.errno in self.BLOCKED:
+                        break
+                    self.errors += 1
+                self.count -= 1
+                self.size -= len(data)
+                if entry[1]:
+                    self.unmodified_size -= len(data)
+                entry[0] = None
+            frames.popleft()
+        while self.unmodified and self.unmodified[0][0] is None:
+            self.unmodified.popleft()
+
+        if not frames:
+            IOLoop.instance().update_handler(self.sock.fileno(), IOLoop.READ)
+        if self.waiter is not None and self.size <= self.low:
+            waiter, self.waiter = self.waiter, None
+            waiter.set_result(None)
+
+    def __str__(self):
+        return "{} frames / {} bytes queued (peak {}){}; sent {}, queued {}, dropped {}, evicted {}, errors {}, paused {} times".format(
+            self.count, self.size, self.peak, ", writers paused" if self.waiter is not None else "",
+            self.sent, self.queued, self.dropped, self.evicted, self.errors, self.pauses)
 
 class LinkLayer(NetLayer):
     NAME="link"
     SNAPLEN=1550
     ETH_P_ALL = 3 
+    # Maximum number of frames drained from a socket per IOLoop wakeup
+    BATCH_SIZE = 64
+    # Maximum number of flows remembered as not worth decoding
+    BYPASS_MAX = 65536
 
     ALICE = 0
     BOB = 1
 
+    BACKENDS = ("socket", "mmap")
+
+    # Per-NIC output queue bounds, in bytes
+    QUEUE_LIMIT = 1 << 20
+    QUEUE_HIGH = 256 << 10
+    QUEUE_LOW = 64 << 10
+
+    SOL_PACKET = 263
+    PACKET_FANOUT = 18
+    PACKET_FANOUT_HASH = 0
+    # Reassemble IP fragments before hashing, so they follow their flow
+    PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
     def __init__(self, alice_nic = "tapa", bob_nic = "tapb", *args, **kwargs):
+        self.batch_size = kwargs.pop("batch_size", self.BATCH_SIZE)
+        # "socket" copies each frame out with recv(); "mmap" reads frames
+        # straight out of a TPACKET_V3 ring, falling back to "socket" if the
+        # ring can't be set up.
+        self.backend = kwargs.pop("backend", "socket")
+        if self.backend not in self.BACKENDS:
+            raise Exception("Unknown link backend '{}'".format(self.backend))
+        # If set, this process joins PACKET_FANOUT group `fanout_group` on
+        # Alice's NIC (and `fanout_group + 1` on Bob's), so several lens
+        # processes can split the frames between them, flow by flow.
+        self.fanout_group = kwargs.pop("fanout_group", None)
+        # See OutputQueue
+        self.queue_limit = kwargs.pop("queue_limit", self.QUEUE_LIMIT)
+        self.queue_high = kwargs.pop("queue_high", self.QUEUE_HIGH)
+        self.queue_low = kwargs.pop("queue_low", self.QUEUE_LOW)
+        self.drop_policy = kwargs.pop("drop_policy", "tail")
+        if self.drop_policy not in OutputQueue.POLICIES:
+            raise Exception("Unknown drop policy '{}'".format(self.drop_policy))
         super(LinkLayer, self).__init__(*args, **kwargs)
+        self.make_toggle("fastpath", default=True)
+        self.bypass_flows = set()
+        self.bypass_hits = 0
+
+        self.rings = {}
+        self.socks = {}
+        self.queues = {}
+        self.backend_error = None
+        # NICs that hand the kernel their own (RSS) receive hash, which can
+        # break fanout: see join_fanout
+        self.rxhash_nics = []
+        self.open(alice_nic, bob_nic)
+
+    def open(self, alice_nic, bob_nic):
+        # Attach to both NICs and start reading from them
+        # Override me  -- for sources that aren't live NICs
         alice_sock = self.attach(alice_nic)
         bob_sock = self.attach(bob_nic)
 
+        if self.backend == "mmap":
+            try:
+                self.rings[self.ALICE] = PacketRing(alice_sock)
+                self.rings[self.BOB] = PacketRing(bob_sock)
+            except (EnvironmentError, ValueError) as e:
+                # A socket with a ring attached can't go back to plain recv()
+                for ring in self.rings.values():
+                    ring.close()
+                self.rings = {}
+                alice_sock.close()
+                bob_sock.close()
+                alice_sock = self.attach(alice_nic)
+                bob_sock = self.attach(bob_nic)
+                self.backend = "socket"
+                self.backend_error = e
+
+        if self.fanout_group is not None:
+            self.join_fanout(alice_sock, self.fanout_group)
+            self.join_fanout(bob_sock, self.fanout_group + 1)
+            self.rxhash_nics = [nic for nic in (alice_nic, bob_nic) if self.has_rxhash(nic)]
+            for nic in self.rxhash_nics:
+                self.log("Warning: {0} has receive hashing on, so fanout may split flows between shards. Try 'ethtool -K {0} rxhash off'", nic)
+
         io_loop = IOLoop.instance()
 
-        self.alice_stream = IOStream(alice_sock)
-        self.bob_stream = IOStream(bob_sock)
+        self.socks = {self.ALICE: alice_sock, self.BOB: bob_sock}
+        for dst, sock in self.socks.items():
+            self.queues[dst] = OutputQueue(sock, self.queue_limit, self.queue_high, self.queue_low, self.drop_policy)
 
         io_loop.add_handler(alice_sock.fileno(), self.alice_read, IOLoop.READ)
         io_loop.add_handler(bob_sock.fileno(), self.bob_read, IOLoop.READ)
@@ -44,19 +395,269 @@ class LinkLayer(NetLayer):
         sock.setblocking(0)
         return sock
 
+    @classmethod
+    def join_fanout(cls, sock, group):
+        # In hash mode a frame goes to the member picked by its skb flow
+        # hash. When the kernel computes that hash itself it's symmetric, so
+        # both directions of a flow go to the same member, as long as every
+        # process joins both NICs' groups in the same order (members are
+        # numbered by when they joined).
+        # But a NIC doing RSS can supply its own hash, which usually isn't
+        # symmetric: the NICs must have receive hashing off (or a symmetric
+        # RSS key), or a flow's two directions can land on different shards.
+        flags = cls.PACKET_FANOUT_HASH | cls.PACKET_FANOUT_FLAG_DEFRAG
+        sock.setsockopt(cls.SOL_PACKET, cls.PACKET_FANOUT, struct.pack("I", (group & 0xFFFF) | (flags << 16)))
+
+    @staticmethod
+    def has_rxhash(nic):
+        # Whether `nic` has receive hashing offload turned on, if ethtool
+        # can tell
+        try:
+            features = subprocess.check_output(["ethtool", "-k", nic], stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return "receive-hashing: on" in features
+
     def alice_read(self, fd, event):
-        data = self.alice_stream.socket.recv(self.SNAPLEN)
-        self.add_future(self.on_read(self.ALICE, {}, data[:-2]))
+        self.handle_events(self.ALICE, event)
 
     def bob_read(self, fd, event):
-        data = self.bob_stream.socket.recv(self.SNAPLEN)
-        self.add_future(self.on_read(self.BOB, {}, data[:-2]))
+        self.handle_events(self.BOB, event)
+
+    def handle_events(self, nic, event):
+        # The NIC's output queue only asks for WRITE events while it has
+        # frames waiting
+        if event & IOLoop.WRITE:
+            self.queues[nic].flush()
+        if event & ~IOLoop.WRITE:
+            self.read_batch(nic, self.socks[nic])
+
+    def recv_batch(self, sock):
+        # Drain every pending frame (up to `batch_size`) from a non-blocking
+        # socket, so a burst costs one wakeup instead of one per frame
+        frames = []
+        recv = sock.recv
+        snaplen = self.SNAPLEN
+        for i in xrange(self.batch_size):
+            try:
+                data = recv(snaplen)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            frames.append(data[:-2])
+        return frames
+
+    def read_batch(self, src, sock):
+        ring = self.rings.get(src)
+        if ring is not None:
+            ring.drain(lambda data: self.dispatch(src, data))
+            return
+        for data in self.recv_batch(sock):
+            self.dispatch(src, data)
+
+    def dispatch(self, src, data):
+        # Frames of flows that no layer wants are forwarded to the other NIC
+        # untouched, without being decoded and re-encoded by the tree
+        # Layers are called synchronously, so a frame that makes one raise
+        # is logged & dropped here rather than taking the rest of the batch
+        # (or the replay) with it
+        try:
+            if self.bypass_flows and self.fastpath and frame_flow_key(data) in self.bypass_flows:
+                self.bypass_hits += 1
+                self.add_future(self.write(self.route(src, None), None, data))
+            else:
+                self.add_future(self.on_read(src, None, data))
+        except Exception:
+            traceback.print_exc()
+
+    def add_bypass(self, header, sport, dport):
+        if len(self.bypass_flows) >= self.BYPASS_MAX:
+            self.bypass_flows.clear()
+        self.bypass_flows.add(flow_key(header["ip_p"], header["ip_src"], sport, header["ip_dst"], dport))
+
+    def on_tree_changed(self):
+        # Layers that were added may want flows we've been bypassing
+        self.bypass_flows.clear()
+
+    def do_bypass(self, *args):
+        """bypass [flush] - Show or forget flows forwarded without decoding."""
+        if args and args[0] == "flush":
+            self.bypass_flows.clear()
+        return "Fast path {}: {} flows, {} frames forwarded".format(
+            "on" if self.fastpath else "off", len(self.bypass_flows), self.bypass_hits)
+
+    def do_batch(self, size=None):
+        """batch [size] - Show or set the max number of frames read per wakeup."""
+        if size is not None:
+            self.batch_size = max(1, int(size))
+        return "Batch size: {}".format(self.batch_size)
+
+    def do_queues(self, *args):
+        """queues [reset|policy tail|bypass|limit|high|low <bytes>] - Show or configure the output queues."""
+        if args:
+            if args[0] == "reset":
+                for queue in self.queues.values():
+                    queue.reset()
+            elif args[0] == "policy" and len(args) == 2:
+                if args[1] not in OutputQueue.POLICIES:
+                    raise Exception("Unknown drop policy '{}'".format(args[1]))
+                self.drop_policy = args[1]
+            elif args[0] in ("limit", "high", "low") and len(args) == 2:
+                setattr(self, "queue_" + args[0], max(0, int(args[1])))
+            else:
+                raise Exception("Unknown queues command '{}'".format(" ".join(args)))
+            for queue in self.queues.values():
+                queue.policy = self.drop_policy
+                queue.limit = self.queue_limit
+                queue.high = self.queue_high
+                queue.low = self.queue_low
+        output = "Drop policy {}; limit {}, high {}, low {} bytes".format(
+            self.drop_policy, self.queue_limit, self.queue_high, self.queue_low)
+        for dst, queue in sorted(self.queues.items()):
+            output += "\n {}: {}".format("AB"[dst], queue)
+        return output
+
+    def do_backend(self):
+        """Show which capture backend is in use."""
+        output = "Backend: {}".format(self.backend)
+        if self.fanout_group is not None:
+            output += ", fanout groups {} & {}".format(self.fanout_group, self.fanout_group + 1)
+            if self.rxhash_nics:
+                output += " (receive hashing on {}: flows may be split)".format(", ".join(self.rxhash_nics))
+        if self.backend_error is not None:
+            output += " (mmap unavailable: {})".format(self.backend_error)
+        for dst, ring in sorted(self.rings.items()):
+            output += "\n {}: tx ring {}, {} frames dropped".format(
+                "AB"[dst], "on" if ring.has_tx else "off", ring.tx_dropped)
+        return output
 
     # coroutine
+    # `header` is None for frames no layer has decoded, such as those of
+    # bypassed flows, which the "bypass" drop policy gives up first
     def write(self, dst, header, data):
-        if dst == self.ALICE:
-            return self.alice_stream.write(data)
-        elif dst == self.BOB:
-            return self.bob_stream.write(data)
-        else:
+        ring = self.rings.get(dst)
+        if ring is not None and ring.has_tx:
+            ring.send(data)
+            return DONE
+        elif ring is not None:
+            # The queue may hold on to `data` past the lifetime of a ring slot
+            data = str(data)
+        queue = self.queues.get(dst)
+        if queue is None:
             raise Exception("Bad destination")
+        return queue.write(data, header is None)
+
+class PcapLinkLayer(LinkLayer):
+    # A source that replays a capture file instead of attaching to NICs, and
+    # writes whatever would have been sent on each NIC to a pcap file.
+    # Frames are assigned to Alice either by pcapng interface id, or by source
+    # MAC (defaulting to the sender of the first frame).
+    # `speed` scales the capture's timing: 1.0 replays in real time, None
+    # replays as fast as the layers can keep up. Output frames are stamped
+    # with the capture time of the frame being replayed, so output files are
+    # the same from one run to the next.
+    NAME = "pcap"
+
+    def __init__(self, capture, alice_out=None, bob_out=None, *args, **kwargs):
+        self.capture = capture
+        self.outputs = {self.ALICE: alice_out, self.BOB: bob_out}
+        # "aa:bb:cc:dd:ee:ff"
+        self.alice_mac = kwargs.pop("alice_mac", None)
+        if self.alice_mac is not None:
+            self.alice_mac = wire_mac(self.alice_mac)
+        self.alice_interface = kwargs.pop("alice_interface", None)
+        self.speed = kwargs.pop("speed", None)
+        self.done = gen.Future()
+        super(PcapLinkLayer, self).__init__(*args, **kwargs)
+
+    def open(self, alice_nic, bob_nic):
+        self.capture_file = open(self.capture, "rb")
+        self.frames = read_capture(self.capture_file)
+        self.writers = dict((dst, CaptureWriter(filename))
+                            for dst, filename in self.outputs.items() if filename is not None)
+        self.read_counts = {self.ALICE: 0, self.BOB: 0}
+        self.write_counts = {self.ALICE: 0, self.BOB: 0}
+        self.clock = None
+        self.start_time = None
+        self.start_clock = None
+        self.pending = None
+        self.paused = False
+        IOLoop.instance().add_callback(self.replay)
+
+    def source(self, interface, frame):
+        if self.alice_interface is not None and interface is not None:
+            return self.ALICE if interface == self.alice_interface else self.BOB
+        if self.alice_mac is None:
+            self.alice_mac = frame[6:12]
+        return self.ALICE if frame[6:12] == self.alice_mac else self.BOB
+
+    def replay(self):
+        # Dispatch up to `batch_size` frames, then yield to the IOLoop so the
+        # futures they spawned can run
+        if self.paused or self.done.done():
+            return
+        io_loop = IOLoop.instance()
+        for i in xrange(self.batch_size):
+            if self.pending is None:
+                try:
+                    self.pending = next(self.frames)
+                except StopIteration:
+                    io_loop.add_callback(self.finish)
+                    return
+            ts, interface, frame = self.pending
+            if self.speed:
+                if self.start_time is None:
+                    self.start_time = io_loop.time()
+                    self.start_clock = ts
+                due = self.start_time + (ts - self.start_clock) / self.speed
+                if due > io_loop.time():
+                    io_loop.call_at(due, self.replay)
+                    return
+            self.pending = None
+            if len(frame) < 14:
+                continue
+            self.clock = ts
+            src = self.source(interface, frame)
+            self.read_counts[src] += 1
+            self.dispatch(src, frame)
+        io_loop.add_callback(self.replay)
+
+    def finish(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.capture_file.close()
+        self.done.set_result(self.read_counts[self.ALICE] + self.read_counts[self.BOB])
+
+    # coroutine
+    def write(self, dst, header, data):
+        if dst not in self.write_counts:
+            raise Exception("Bad destination")
+        self.write_counts[dst] += 1
+        writer = self.writers.get(dst)
+        if writer is not None:
+            writer.write(self.clock, data)
+        return DONE
+
+    def do_replay(self, *args):
+        """replay [pause|resume] - Show replay progress, or pause/resume it."""
+        if args and args[0] == "pause":
+            self.paused = True
+        elif args and args[0] == "resume" and self.paused:
+            self.paused = False
+            # Timing restarts from the next frame
+            self.start_time = None
+            IOLoop.instance().add_callback(self.replay)
+        state = "done" if self.done.done() else "paused" if self.paused else "running"
+        return "Replay of '{}' {}: A sent {}, received {}; B sent {}, received {}".format(
+            self.capture, state,
+            self.read_counts[self.ALICE], self.write_counts[self.ALICE],
+            self.read_counts[self.BOB], self.write_counts[self.BOB])
+
+    def do_speed(self, speed=None):
+        """speed [factor|max] - Show or set the replay speed relative to real time."""
+        if speed is not None:
+            self.speed = None if speed == "max" else float(speed)
+            self.start_time = None
+        return "Speed: {}".format("{}x".format(self.speed) if self.speed else "max")
@@ -0,0 +1,57 @@
+# A log handler for busy layers: messages are kept in a bounded in-memory
+# ring and written to disk in batches from the IOLoop, instead of with a
+# write per message on the packet path.
+
+import collections
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+class RingFileLogger(object):
+    # Usable anywhere a log handler is, e.g. `layer.add_logger(RingFileLogger("tcp.log"))`
+    # If more than `max_lines` messages arrive between flushes, the oldest are
+    # dropped (and counted). The file is kept under `max_bytes` by moving it
+    # to `<filename>.1` when it fills up.
+    FLUSH_INTERVAL_MS = 200
+    MAX_LINES = 100000
+    MAX_BYTES = 64 << 20
+
+    def __init__(self, filename, max_lines=MAX_LINES, max_bytes=MAX_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+        self.written = 0
+        self.f = open(filename, "a")
+        self.size = self.f.tell()
+        self.flusher = PeriodicCallback(self.flush, self.FLUSH_INTERVAL_MS)
+        self.flusher.start()
+
+    def __call__(self, message):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append((time.time(), message))
+
+    def flush(self):
+        if not self.lines:
+            return
+        data = "".join("{:.6f} {}\n".format(t, message) for t, message in self.lines)
+        self.written += len(self.lines)
+        self.lines.clear()
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.f.close()
+            os.rename(self.filename, self.filename + ".1")
+            self.f = open(self.filename, "w")
+            self.size = 0
+        self.f.write(data)
+        self.f.flush()
+        self.size += len(data)
+
+    def close(self):
+        self.flusher.stop()
+        self.flush()
+        self.f.close()
+
+    def __str__(self):
+        return "Logging to '{}': {} lines written, {} dropped".format(self.filename, self.written, self.dropped)
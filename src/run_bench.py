@@ -0,0 +1,347 @@
+#!/usr/bin/python2
+# Packet processing benchmarks
+#
+# Replays pcap captures through a layer graph with the NICs replaced by a
+# loopback sink, and reports throughput, per-packet latency & per-layer costs.
+# Doesn't need root or a tap, so it can be run anywhere to catch throughput
+# regressions before deploying.
+#
+#   run_bench.py                      - run every built-in scenario
+#   run_bench.py http rtsp            - run some of the built-in scenarios
+#   run_bench.py -g graphs/vim.py x.pcap
+#                                     - replay a capture through a graph
+#   run_bench.py --save /tmp          - write the built-in scenarios out as pcaps
+
+import argparse
+import gc
+import os
+import socket
+import struct
+import sys
+import time
+
+import dpkt
+from tornado.ioloop import IOLoop
+
+import base
+import capture
+import eventloop
+import link
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GRAPH = os.path.join(SRC_DIR, "graphs", "cloud2butt.py")
+
+ALICE = link.LinkLayer.ALICE
+BOB = link.LinkLayer.BOB
+
+# Alice is the client & Bob the server in the built-in scenarios
+ENDPOINTS = {
+    ALICE: ("\x02\x00\x00\x00\x00\x0a", socket.inet_aton("10.0.0.1")),
+    BOB: ("\x02\x00\x00\x00\x00\x0b", socket.inet_aton("10.0.0.2")),
+}
+
+def make_frame(src, p, payload):
+    src_mac, src_ip = ENDPOINTS[src]
+    dst_mac, dst_ip = ENDPOINTS[1 - src]
+    pkt = dpkt.ip.IP(src=src_ip, dst=dst_ip, p=p, ttl=64, data=payload)
+    pkt.len += len(pkt.data)
+    return str(dpkt.ethernet.Ethernet(src=src_mac, dst=dst_mac, type=dpkt.ethernet.ETH_TYPE_IP, data=pkt))
+
+class TCPSession(object):
+    # Builds the frames of one TCP connection from Alice to Bob
+    MSS = 1400
+
+    def __init__(self, frames, sport, dport):
+        self.frames = frames
+        self.ports = {ALICE: (sport, dport), BOB: (dport, sport)}
+        self.seq = {ALICE: 1000, BOB: 500000}
+        self.ts = 1
+
+    def segment(self, src, flags, data="", opts=()):
+        sport, dport = self.ports[src]
+        self.ts += 1
+        opts = [(dpkt.tcp.TCP_OPT_TIMESTAMP, struct.pack("!II", self.ts, self.ts - 1))] + list(opts)
+        pkt = dpkt.tcp.TCP(sport=sport, dport=dport, seq=self.seq[src], flags=flags, win=65535, data=data)
+        if flags & dpkt.tcp.TH_ACK:
+            pkt.ack = self.seq[1 - src]
+        pkt.opts = "".join(chr(kind) + chr(len(value) + 2) + value for kind, value in opts)
+        pkt.opts += "\x01" * (-len(pkt.opts) % 4)
+        pkt.off += len(pkt.opts) / 4
+        self.seq[src] += len(data) + (1 if flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN) else 0)
+        self.frames.append(make_frame(src, dpkt.ip.IP_PROTO_TCP, pkt))
+
+    def open(self):
+        mss = [(dpkt.tcp.TCP_OPT_MSS, struct.pack("!H", 1460))]
+        self.segment(ALICE, dpkt.tcp.TH_SYN, opts=mss)
+        self.segment(BOB, dpkt.tcp.TH_SYN | dpkt.tcp.TH_ACK, opts=mss)
+        self.segment(ALICE, dpkt.tcp.TH_ACK)
+
+    def send(self, src, data):
+        # Delayed ACKs: the receiver ACKs every other segment
+        for i, offset in enumerate(range(0, len(data), self.MSS)):
+            self.segment(src, dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH, data[offset:offset + self.MSS])
+            if i % 2:
+                self.segment(1 - src, dpkt.tcp.TH_ACK)
+        self.segment(1 - src, dpkt.tcp.TH_ACK)
+
+    def close(self):
+        self.segment(ALICE, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK)
+        self.segment(BOB, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK)
+        self.segment(ALICE, dpkt.tcp.TH_ACK)
+
+def udp_frame(src, sport, dport, data):
+    pkt = dpkt.udp.UDP(sport=sport, dport=dport, data=data)
+    pkt.ulen += len(data)
+    return make_frame(src, dpkt.ip.IP_PROTO_UDP, pkt)
+
+def http_page(size):
+    body = "<p>Welcome to the cloud, where everything is stored in the cloud.</p>\n"
+    body = "<html><body>\n" + body * (size / len(body)) + "</body></html>\n"
+    return "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {}\r\n\r\n{}".format(len(body), body)
+
+def scenario_http():
+    # Page loads over port 80, each on its own connection
+    frames = []
+    for i, size in enumerate([2000, 15000, 60000] * 20):
+        session = TCPSession(frames, 40000 + i, 80)
+        session.open()
+        session.send(ALICE, "GET /{} HTTP/1.1\r\nHost: example.com\r\nAccept: */*\r\n\r\n".format(i))
+        session.send(BOB, http_page(size))
+        session.close()
+    return frames
+
+def scenario_rtsp():
+    # An RTSP session on port 554 setting up RTP on port 40000, followed by
+    # misc/jake.h264 packetized as RTP (RFC 6184, single NAL units & FU-A)
+    frames = []
+    session = TCPSession(frames, 41000, 554)
+    session.open()
+    url = "rtsp://10.0.0.2/jake"
+    for cseq, (method, extra) in enumerate([
+            ("DESCRIBE", "Accept: application/sdp\r\n"),
+            ("SETUP", "Transport: RTP/AVP;unicast;client_port=40000-40001\r\n"),
+            ("PLAY", "Session: 1\r\nRange: npt=0.000-\r\n")], 1):
+        session.send(ALICE, "{} {} RTSP/1.0\r\nCSeq: {}\r\n{}\r\n".format(method, url, cseq, extra))
+        body = "v=0\r\nm=video 0 RTP/AVP 96\r\na=rtpmap:96 H264/90000\r\n" if method == "DESCRIBE" else ""
+        session.send(BOB, "RTSP/1.0 200 OK\r\nCSeq: {}\r\nContent-Length: {}\r\n\r\n{}".format(cseq, len(body), body))
+
+    with open(os.path.join(SRC_DIR, "..", "misc", "jake.h264")) as f:
+        stream = f.read()
+    seq = 0
+    timestamp = 0
+    for nal in stream.split("\x00\x00\x01")[1:]:
+        nal = nal.rstrip("\x00")
+        if not nal:
+            continue
+        h0 = ord(nal[0])
+        if h0 & 0x1F in (1, 5):
+            timestamp += 3600
+        if len(nal) <= 1396:
+            payloads = [nal]
+        else:
+            fu = chr(h0 & 0xE0 | 28)
+            chunks = [nal[i:i + 1394] for i in range(1, len(nal), 1394)]
+            payloads = [fu + chr(h0 & 0x1F | (0x80 if i == 0 else 0) | (0x40 if i == len(chunks) - 1 else 0)) + chunk
+                        for i, chunk in enumerate(chunks)]
+        for i, payload in enumerate(payloads):
+            mark = 0x80 if i == len(payloads) - 1 else 0
+            rtp = struct.pack("!BBHII", 0x80, 96 | mark, seq, timestamp, 0x1234)
+            seq = (seq + 1) & 0xFFFF
+            frames.append(udp_frame(BOB, 50000, 40000, rtp + payload))
+    return frames
+
+def bulk_transfer(port):
+    frames = []
+    session = TCPSession(frames, 42000, port)
+    session.open()
+    session.send(ALICE, os.urandom(4 << 20))
+    session.close()
+    return frames
+
+def scenario_bulk():
+    # A 4MB upload terminated & re-originated by TCPLayer
+    return bulk_transfer(5001)
+
+def scenario_passthru():
+    # A 4MB upload that no layer wants, forwarded by LinkLayer's fast path
+    return bulk_transfer(5002)
+
+SCENARIOS = [
+    ("http", scenario_http, DEFAULT_GRAPH),
+    ("rtsp", scenario_rtsp, os.path.join(SRC_DIR, "graphs", "record.py")),
+    ("bulk", scenario_bulk, os.path.join(SRC_DIR, "graphs", "tcp_proxy.py")),
+    ("passthru", scenario_passthru, os.path.join(SRC_DIR, "graphs", "tcp_proxy.py")),
+]
+
+def write_pcap(filename, frames):
+    writer = capture.CaptureWriter(filename)
+    for i, frame in enumerate(frames):
+        writer.write(i * 0.0001, frame)
+    writer.close()
+
+def read_pcap(f):
+    return [frame for ts, interface, frame in capture.read_capture(f) if len(frame) >= 14]
+
+def assign_sources(frames):
+    # Returns a list of (src, frame), taking whoever sent the first frame as Alice
+    alice_mac = frames[0][6:12] if frames else None
+    return [(ALICE if frame[6:12] == alice_mac else BOB, frame) for frame in frames]
+
+class BenchLinkLayer(link.LinkLayer):
+    # Stands in for the NICs: frames are fed in with `dispatch` and whatever
+    # would have been sent is counted & thrown away
+    NAME = "link"
+
+    def open(self, alice_nic, bob_nic):
+        self.sent_packets = 0
+        self.sent_bytes = 0
+
+    def write(self, dst, header, data):
+        self.sent_packets += 1
+        self.sent_bytes += len(str(data))
+        return base.DONE
+
+class LayerProfiler(object):
+    # Wraps the entry points of every layer in a graph to find how much time
+    # each layer spends, & how many objects it leaves allocated, excluding the
+    # layers it calls into. Only objects tracked by the garbage collector
+    # (containers, instances, frames...) are counted, not strings.
+    METHODS = ("on_read", "write", "on_close")
+
+    def __init__(self, root):
+        self.stats = []
+        self.stack = []
+        names = set()
+        layers = [root]
+        while layers:
+            layer = layers.pop(0)
+            name = layer.name
+            while name in names:
+                name += "'"
+            names.add(name)
+            stats = {"name": name, "calls": 0, "time": 0.0, "objects": 0}
+            self.stats.append(stats)
+            for method in self.METHODS:
+                setattr(layer, method, self.wrap(getattr(layer, method), stats))
+            layers.extend(layer.children)
+
+    def wrap(self, method, stats):
+        stack = self.stack
+        def wrapper(*args):
+            stack.append([0.0, 0])
+            objects = gc.get_count()[0]
+            start = time.time()
+            try:
+                return method(*args)
+            finally:
+                elapsed = time.time() - start
+                objects = gc.get_count()[0] - objects
+                inner_time, inner_objects = stack.pop()
+                stats["calls"] += 1
+                stats["time"] += elapsed - inner_time
+                stats["objects"] += objects - inner_objects
+                if stack:
+                    stack[-1][0] += elapsed
+                    stack[-1][1] += objects
+        return wrapper
+
+def load_graph(graph):
+    root = BenchLinkLayer(None, None)
+    execfile(graph, {"root": root})
+    return root
+
+def replay(root, frames):
+    # Feed `frames` through the graph, timing each one
+    # Returns per-frame latencies (seconds)
+    io_loop = IOLoop.instance()
+    latencies = []
+    for i, (src, frame) in enumerate(frames):
+        start = time.time()
+        root.dispatch(src, frame)
+        latencies.append(time.time() - start)
+        # Let any callbacks that were scheduled run
+        if i % root.batch_size == 0:
+            io_loop.run_sync(lambda: None)
+    io_loop.run_sync(lambda: None)
+    return latencies
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(name, graph, frames, repeat, profile):
+    in_bytes = sum(len(frame) for src, frame in frames)
+    print "== {}: {} frames, {:.1f} kB through {}".format(name, len(frames), in_bytes / 1e3, os.path.relpath(graph))
+
+    latencies = []
+    elapsed = 0
+    for i in range(repeat):
+        root = load_graph(graph)
+        start = time.time()
+        latencies += replay(root, frames)
+        elapsed += time.time() - start
+    latencies.sort()
+    print "  {:.0f} pkts/s  {:.2f} MB/s  latency p50 {:.1f}us p99 {:.1f}us  ({} pkts, {:.1f} kB out)".format(
+        len(latencies) / elapsed,
+        in_bytes * repeat / elapsed / 1e6,
+        percentile(latencies, 50) * 1e6,
+        percentile(latencies, 99) * 1e6,
+        root.sent_packets,
+        root.sent_bytes / 1e3)
+
+    if profile:
+        # Profiled separately, as the wrappers skew the figures above
+        root = load_graph(graph)
+        profiler = LayerProfiler(root)
+        gc.disable()
+        try:
+            replay(root, frames)
+        finally:
+            gc.enable()
+        print "  {:<20} {:>8} {:>10} {:>10}".format("layer", "calls", "us/call", "objs/call")
+        for stats in profiler.stats:
+            if stats["calls"]:
+                print "  {:<20} {:>8} {:>10.2f} {:>10.2f}".format(
+                    stats["name"],
+                    stats["calls"],
+                    stats["time"] / stats["calls"] * 1e6,
+                    stats["objects"] / float(stats["calls"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay packet captures through a layer graph & measure it.")
+    parser.add_argument("captures", nargs="*",
+            help="built-in scenarios ({}) or pcap files; default: all scenarios".format(", ".join(s[0] for s in SCENARIOS)))
+    parser.add_argument("-g", "--graph", default=None,
+            help="graph file to replay pcap files through (default: graphs/cloud2butt.py)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+            help="number of times to replay each capture (default: 3)")
+    parser.add_argument("--no-profile", dest="profile", action="store_false",
+            help="skip the per-layer breakdown")
+    parser.add_argument("--save", metavar="DIR",
+            help="write the selected built-in scenarios to DIR as pcap files & exit")
+    parser.add_argument("--loop", choices=eventloop.LOOPS, default="tornado", help="event loop to run on")
+    args = parser.parse_args()
+
+    eventloop.install(args.loop)
+
+    scenarios = dict((name, (build, graph)) for name, build, graph in SCENARIOS)
+    captures = args.captures or [name for name, build, graph in SCENARIOS]
+
+    for name in captures:
+        if name in scenarios:
+            build, graph = scenarios[name]
+            frames = build()
+            if args.save:
+                path = os.path.join(args.save, name + ".pcap")
+                write_pcap(path, frames)
+                print "Wrote {}".format(path)
+                continue
+        elif os.path.exists(name):
+            graph = args.graph or DEFAULT_GRAPH
+            with open(name, "rb") as f:
+                frames = read_pcap(f)
+        else:
+            print "Unknown scenario or file: '{}'".format(name)
+            sys.exit(1)
+        if args.graph:
+            graph = args.graph
+        run(name, graph, assign_sources(frames), args.repeat, args.profile)
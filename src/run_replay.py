@@ -0,0 +1,69 @@
+#!/usr/bin/python2
+# Replays a pcap/pcapng capture through a graph without any NICs
+#
+#   run_replay.py [-g graphs/main.py] [-o out] [--speed 1.0] capture.pcap
+#
+# Frames the graph sends towards Alice & Bob are written to <out>.alice.pcap
+# and <out>.bob.pcap
+
+import argparse
+import json
+import time
+
+from tornado.ioloop import IOLoop
+
+import eventloop
+import link
+import shell
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a capture through a layer graph.")
+    parser.add_argument("capture", help="pcap or pcapng file to replay")
+    parser.add_argument("-g", "--graph", help="graph file to load")
+    parser.add_argument("-o", "--output", help="prefix for the output pcap files")
+    parser.add_argument("--speed", type=float, default=None,
+            help="replay speed relative to the capture's timing (default: as fast as possible)")
+    parser.add_argument("--alice-mac", help="frames from this MAC are from Alice (default: the first frame's sender)")
+    parser.add_argument("--alice-interface", type=int, help="frames captured on this pcapng interface id are from Alice")
+    parser.add_argument("--stats", metavar="FILE", help="collect per-layer stats & write them to FILE as JSON")
+    parser.add_argument("--shell", action="store_true", help="start a shell, and keep running after the replay")
+    parser.add_argument("--loop", choices=eventloop.LOOPS, default="tornado", help="event loop to run on")
+    args = parser.parse_args()
+
+    eventloop.install(args.loop)
+
+    outputs = {}
+    if args.output:
+        outputs = {"alice_out": args.output + ".alice.pcap", "bob_out": args.output + ".bob.pcap"}
+    root = link.PcapLinkLayer(args.capture, speed=args.speed,
+            alice_mac=args.alice_mac, alice_interface=args.alice_interface, **outputs)
+    if args.shell:
+        sh = shell.CommandShell(root)
+
+    if args.graph:
+        v = {"root":root}
+        execfile(args.graph, v)
+
+    layers = []
+    if args.stats:
+        def find_layers(layer, name):
+            layers.append((name, layer))
+            for child in layer.children:
+                find_layers(child, "{}.{}".format(name, child.name))
+        find_layers(root, root.name)
+        for name, layer in layers:
+            layer.stats.enable()
+
+    io_loop = IOLoop.instance()
+    start = time.time()
+    if not args.shell:
+        io_loop.add_future(root.done, lambda f: io_loop.stop())
+    io_loop.start()
+    elapsed = time.time() - start
+
+    print root.do_replay()
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(dict((name, layer.stats.to_dict()) for name, layer in layers), f, indent=2, sort_keys=True)
+
+    print "{} frames in {:.2f}s ({:.0f} frames/s)".format(root.done.result(), elapsed, root.done.result() / max(elapsed, 1e-6))
@@ -1,9 +1,13 @@
 #!/usr/bin/python2
 
+import argparse
 import sys
+import control
 import driver
+import eventloop
 import shell
 import link
+import shard
 from tornado.ioloop import IOLoop
 
 import base
@@ -17,23 +21,52 @@ import util
 import video
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("graph", nargs="?", help="graph file to load")
+    parser.add_argument("--loop", choices=eventloop.LOOPS, default="tornado", help="event loop to run on")
+    parser.add_argument("--shards", type=int, default=0,
+            help="hash flows across this many worker processes, each running its own copy of the graph")
+    parser.add_argument("--shard", type=int, default=None, metavar="INDEX",
+            help="run as shard INDEX of several lens processes sharing the NICs through PACKET_FANOUT")
+    parser.add_argument("--fanout-group", type=int, default=0x4c45,
+            help="PACKET_FANOUT group id for Alice's NIC (Bob's uses the next one)")
+    args = parser.parse_args()
 
-    root = link.LinkLayer()
+    eventloop.install(args.loop)
+
+    if args.shard:
+        # Join the fanout groups in shard order, so that each NIC's group
+        # numbers its members the same way
+        if not control.wait_for(control.PATH.format(args.shard - 1), timeout=30):
+            print "Shard {} isn't running".format(args.shard - 1)
+            sys.exit(1)
+
+    if args.shards:
+        root = shard.ShardedLinkLayer(shards=args.shards, graph=args.graph, loop=args.loop)
+    elif args.shard is not None:
+        root = link.LinkLayer(fanout_group=args.fanout_group)
+    else:
+        root = link.LinkLayer()
     sh = shell.CommandShell(root)
+    if args.shard is not None:
+        sh.control = control.ControlServer(sh.run_command, args.shard)
 
-    if len(sys.argv) == 2:
-        graph = sys.argv[1]
+    if args.graph is not None and not args.shards:
         v = {"root":root}
-        execfile(graph, v)
-    elif len(sys.argv) > 2:
-        print "Only one argument allowed (graph file to load)"
-        sys.exit(1)
+        execfile(args.graph, v)
 
     #tap = driver.FakeTap()
-    tap = driver.Tap()
+    if args.shard:
+        # The tap is shared, so only the first shard switches it
+        tap = driver.FakeTap()
+    else:
+        tap = driver.Tap()
     tap.mitm()
     
     try:
         IOLoop.instance().start()
     finally:
         tap.passthru()
+        root.cleanup()
+        if sh.control is not None:
+            sh.control.close()
@@ -0,0 +1,182 @@
+# Flow-sharded processing across worker processes
+#
+# ShardedLinkLayer captures from the NICs like LinkLayer, but instead of
+# decoding frames itself it hashes each one by its flow (the same symmetric
+# key for both directions) and hands it to one of N forked worker processes.
+# Unlike PACKET_FANOUT (see LinkLayer.join_fanout), that doesn't depend on
+# the NIC's receive hash being symmetric.
+# Every worker runs its own copy of the graph under a WorkerLinkLayer root and
+# sends back the frames it wants written, which the dispatcher puts on the
+# NICs. Since a flow always lands on the same worker, per-connection state
+# (TCPLayer.connections, HTTPLayer.connections...) stays local to a worker.
+#
+# Frames travel over SOCK_SEQPACKET socketpairs as one message each: a byte
+# giving the NIC the frame came from (or is going to), then the frame.
+# Frames going back to the NICs have UNMODIFIED set in that byte if the
+# worker's graph never decoded them, for the link's drop policy.
+# Frames that aren't TCP/UDP over IPv4 all go to worker 0.
+
+import errno
+import os
+import signal
+import socket
+
+from tornado.ioloop import IOLoop
+
+import eventloop
+from base import DONE, PacketContext
+from link import LinkLayer, frame_flow_key
+
+SOCKET_BUFFER = 4 << 20
+UNMODIFIED = 0x80
+
+def make_channel():
+    # A pair of connected sockets carrying one frame per message
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    for sock in pair:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        sock.setblocking(0)
+    return pair
+
+def send_frame(sock, port, data):
+    # Returns False if the frame had to be dropped
+    try:
+        sock.send(chr(port) + str(data))
+    except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            return False
+        raise
+    return True
+
+def recv_frames(sock, limit):
+    # Up to `limit` (port, frame) pairs waiting on `sock`
+    # A None in the list means the other end has gone away
+    frames = []
+    for i in xrange(limit):
+        try:
+            message = sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+        if not message:
+            frames.append(None)
+            break
+        frames.append((ord(message[0]), message[1:]))
+    return frames
+
+class WorkerLinkLayer(LinkLayer):
+    # Root of a worker's graph: frames come from, and go back to, the
+    # dispatcher over `sock`
+    NAME = "worker"
+
+    def __init__(self, sock, index, *args, **kwargs):
+        self.sock = sock
+        self.index = index
+        self.dropped = 0
+        super(WorkerLinkLayer, self).__init__(None, None, *args, **kwargs)
+
+    def open(self, alice_nic, bob_nic):
+        IOLoop.instance().add_handler(self.sock.fileno(), self.sock_read, IOLoop.READ)
+
+    def sock_read(self, fd, event):
+        for frame in recv_frames(self.sock, self.batch_size):
+            if frame is None:
+                # The dispatcher has exited
+                IOLoop.instance().stop()
+                return
+            self.dispatch(*frame)
+
+    # coroutine
+    def write(self, dst, header, data):
+        port = dst | UNMODIFIED if header is None else dst
+        if not send_frame(self.sock, port, data):
+            self.dropped += 1
+        return DONE
+
+class ShardedLinkLayer(LinkLayer):
+    NAME = "sharded_link"
+
+    def __init__(self, alice_nic="tapa", bob_nic="tapb", *args, **kwargs):
+        self.shard_count = max(1, int(kwargs.pop("shards", 2)))
+        # Graph file each worker loads under its WorkerLinkLayer
+        self.graph = kwargs.pop("graph", None)
+        self.loop = kwargs.pop("loop", "tornado")
+        super(ShardedLinkLayer, self).__init__(alice_nic, bob_nic, *args, **kwargs)
+
+    def open(self, alice_nic, bob_nic):
+        # Fork before attaching to the NICs, so workers don't inherit them
+        self.workers = []
+        for index in range(self.shard_count):
+            self.workers.append(self.spawn(index))
+        self.sent = [0] * self.shard_count
+        self.received = [0] * self.shard_count
+        self.dropped = [0] * self.shard_count
+
+        io_loop = IOLoop.instance()
+        for index, (pid, sock) in enumerate(self.workers):
+            io_loop.add_handler(sock.fileno(), self.worker_reader(index), IOLoop.READ)
+
+        super(ShardedLinkLayer, self).open(alice_nic, bob_nic)
+
+    def spawn(self, index):
+        parent_sock, child_sock = make_channel()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                parent_sock.close()
+                for _pid, sock in self.workers:
+                    sock.close()
+                self.run_worker(index, child_sock)
+            finally:
+                os._exit(0)
+        child_sock.close()
+        return pid, parent_sock
+
+    def run_worker(self, index, sock):
+        # Runs in the forked child
+        # Let the dispatcher handle ^C & shut workers down by closing their sockets
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        io_loop = eventloop.reset_after_fork(self.loop)
+        root = WorkerLinkLayer(sock, index, batch_size=self.batch_size)
+        if self.graph is not None:
+            execfile(self.graph, {"root": root})
+        io_loop.start()
+
+    def worker_reader(self, index):
+        sock = self.workers[index][1]
+        def read(fd, event):
+            for frame in recv_frames(sock, self.batch_size):
+                if frame is None:
+                    self.log("Worker {} exited", index)
+                    IOLoop.instance().remove_handler(fd)
+                    return
+                port, data = frame
+                self.received[index] += 1
+                header = None if port & UNMODIFIED else PacketContext()
+                LinkLayer.write(self, port & ~UNMODIFIED, header, data)
+        return read
+
+    def dispatch(self, src, data):
+        key = frame_flow_key(data)
+        index = hash(key) % self.shard_count if key is not None else 0
+        if send_frame(self.workers[index][1], src, data):
+            self.sent[index] += 1
+        else:
+            self.dropped[index] += 1
+
+    def cleanup(self):
+        super(ShardedLinkLayer, self).cleanup()
+        for pid, sock in self.workers:
+            sock.close()
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def do_shards(self):
+        """Show frames sent to, received from & dropped for each worker."""
+        return "\n".join("Worker {} (pid {}): sent {}, received {}, dropped {}".format(
+            index, pid, self.sent[index], self.received[index], self.dropped[index])
+            for index, (pid, sock) in enumerate(self.workers))
@@ -1,8 +1,16 @@
 import base
+import control
+import eventloop
+import logfile
 
 import fcntl
+import json
 import os
+import socket
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 import traceback
 import sys
 import signal
@@ -35,6 +43,10 @@ class CommandShell(object):
             signal.signal(signal.SIGINT, _sig_handler)
         self.ioloop.add_callback(enable_sig_handler)
 
+        self.log_file = None
+        # Set to a control.ControlServer when running as one of several shards
+        self.control = None
+
         self.write_prompt()
         base.LayerMeta.instance_callback = self.instance_callback
 
@@ -66,6 +78,9 @@ class CommandShell(object):
 
     def instance_callback(self, layer_instance):
         def _log_handler(message):
+            if self.log_file is not None:
+                self.log_file("[{0:s}] {1}".format(layer_instance.NAME, message))
+                return
             self.output.write("\r[{0:s}] {1}\n".format(layer_instance.NAME, message))
             self.write_prompt()
 
@@ -97,14 +112,42 @@ class CommandShell(object):
             self.handle_command(line)
 
     def handle_command(self, input_line):
-        arguments = input_line.split()
-
-        if len(arguments) == 0:
+        if len(input_line.split()) == 0:
             if "\n" not in input_line:
                 self.output.write("\n")
             self.write_prompt()
             return
 
+        try:
+            result = self.run_command(input_line)
+        except ShellQuit:
+            self.ioloop.stop()
+            return
+
+        if isinstance(result, Future):
+            # Shown once it's ready, without holding up the IOLoop
+            self.ioloop.add_future(result, self.show_result)
+            return
+        if result is not None:
+            self.output.write(str(result) + "\n")
+        self.write_prompt()
+
+    def show_result(self, future):
+        try:
+            result = future.result()
+        except Exception:
+            result = traceback.format_exc()
+        if result is not None:
+            self.output.write(str(result) + "\n")
+        self.write_prompt()
+
+    def run_command(self, input_line):
+        # Run one command line & return its output
+        # Raises ShellQuit if the command was `quit`
+        arguments = input_line.split()
+        if len(arguments) == 0:
+            return None
+
         layer, command = None, None
         command = arguments.pop(0).lower()
 
@@ -116,8 +159,7 @@ class CommandShell(object):
             try:
                 result = shell_fn(*arguments)
             except ShellQuit:
-                self.ioloop.stop()
-                return
+                raise
             except Exception as e:
                 result = traceback.format_exc()
         else:
@@ -142,9 +184,7 @@ class CommandShell(object):
             else:
                 result = "Invalid layer '{}'".format(layer)
 
-        if result is not None:
-            self.output.write(str(result) + "\n")
-        self.write_prompt()
+        return result
 
     def layer_name(self, layer):
         return {v: k for k, v in self.layers.items()}.get(layer, None)
@@ -233,6 +273,73 @@ class CommandShell(object):
 
         print "Added '{0}' after '{1}'".format(self.layer_name(middle), layer)
 
+    def do_stats(self, *args):
+        """stats [on|off|reset] | stats json [file] - Control stats on every layer, or dump them as JSON."""
+        layers = self.layers
+        if args and args[0] == "json":
+            output = json.dumps(dict((name, layer.stats.to_dict()) for name, layer in layers.items()),
+                                indent=2, sort_keys=True)
+            if len(args) > 1:
+                with open(args[1], "w") as f:
+                    f.write(output)
+                return "Wrote stats for {} layers to '{}'".format(len(layers), args[1])
+            return output
+        for layer in layers.values():
+            layer.do_stats(*args)
+        return "\n".join("{:16} in {:>8} out {:>8} on_read {:>10} write {:>10}".format(
+            name, layer.stats.counts["packets_in"], layer.stats.counts["packets_out"],
+            "{:.1f}us".format(layer.stats.times["on_read"].total * 1e6),
+            "{:.1f}us".format(layer.stats.times["write"].total * 1e6))
+            for name, layer in sorted(layers.items()))
+
+    def do_logfile(self, filename=None):
+        """logfile [<file>|off] - Write debug logs to <file> in the background instead of the screen."""
+        if filename is None:
+            return str(self.log_file) if self.log_file is not None else "Logging to screen"
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+        if filename != "off":
+            self.log_file = logfile.RingFileLogger(filename)
+            return str(self.log_file)
+        return "Logging to screen"
+
+    def do_shards(self, *args):
+        """shards <command>... - Run a command on every shard of this tap & show each one's output."""
+        if self.control is None:
+            return "Not running as a shard (see run_sandwich.py --shard)"
+        return self.query_shards(" ".join(args))
+
+    @gen.coroutine
+    def query_shards(self, line):
+        # Ask the other shards all at once, so one that's stuck only holds
+        # up this command (for up to control.TIMEOUT), not packet forwarding
+        shards = self.control.shard_paths()
+        replies = [None if index == self.control.index else control.query(path, line)
+                   for index, path in shards]
+        outputs = []
+        for (index, path), reply in zip(shards, replies):
+            if reply is None:
+                try:
+                    result = self.run_command(line)
+                    if isinstance(result, Future):
+                        result = yield result
+                except ShellQuit:
+                    result = "Can't quit other shards"
+            else:
+                try:
+                    result = yield reply
+                except gen.TimeoutError:
+                    result = "No reply within {}s".format(control.TIMEOUT)
+                except (socket.error, StreamClosedError) as e:
+                    result = "Unreachable: {}".format(e)
+            outputs.append("[shard {}]\n{}".format(index, result))
+        raise gen.Return("\n".join(outputs))
+
+    def do_loop(self):
+        """loop - Show which event loop is running."""
+        return eventloop.describe(self.ioloop)
+
     def do_show(self, layername = None):
         """show [layername] - Show tree of connected layers."""
         def printer(l, last = [True]):
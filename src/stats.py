@@ -0,0 +1,170 @@
+# Per-layer packet counters & timing histograms
+#
+# Stats are collected by wrapping a layer's entry points on the instance when
+# they're turned on, and removing the wrappers when they're turned off, so a
+# layer with stats off runs exactly the code it would without them.
+
+import time
+
+from tornado.concurrent import Future
+
+class Histogram(object):
+    # Durations counted in power-of-two buckets of microseconds:
+    # bucket 0 is < 1us, bucket i is [2^(i-1), 2^i) us
+    BUCKETS = 24
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper bound (in seconds) of the bucket holding the p'th percentile
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << i) / 1e6
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets_us": self.buckets,
+        }
+
+    def __str__(self):
+        if not self.count:
+            return "n=0"
+        return "n={} mean {:.1f}us p50 <{:.0f}us p99 <{:.0f}us max {:.1f}us".format(
+            self.count, self.total / self.count * 1e6,
+            self.percentile(50) * 1e6, self.percentile(99) * 1e6, self.max * 1e6)
+
+class LayerStats(object):
+    # Counts messages & bytes in (`on_read`, from below) and out (`write`,
+    # from above or from the layer itself), closes, bubbles and passthrus,
+    # and times `on_read` and `write`.
+    # Times exclude time spent in other layers called from inside them.
+    # "queued" is how long futures returned by `on_read`/`write` took to
+    # resolve, for the calls that didn't complete synchronously.
+    COUNTERS = ("packets_in", "bytes_in", "packets_out", "bytes_out", "closes", "bubbles", "passthrus", "queued")
+    TIMERS = ("on_read", "write", "queued")
+
+    # Time spent in nested calls, shared by all layers
+    stack = []
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.enabled = False
+        self.originals = {}
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.times = dict((name, Histogram()) for name in self.TIMERS)
+        self.since = time.time()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            self.counts[name] = 0
+        for histogram in self.times.values():
+            histogram.reset()
+        self.since = time.time()
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        wrappers = {
+            "on_read": self.timed(self.layer.on_read, "on_read", "packets_in", "bytes_in"),
+            "write": self.timed(self.layer.write, "write", "packets_out", "bytes_out"),
+            "on_close": self.counted(self.layer.on_close, "closes"),
+            "bubble": self.counted(self.layer.bubble, "bubbles"),
+            "passthru": self.counted(self.layer.passthru, "passthrus"),
+        }
+        for name, wrapper in wrappers.items():
+            self.originals[name] = self.layer.__dict__.get(name)
+            setattr(self.layer, name, wrapper)
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        for name, original in self.originals.items():
+            if original is None:
+                delattr(self.layer, name)
+            else:
+                setattr(self.layer, name, original)
+        self.originals = {}
+
+    def timed(self, method, timer, packets, size):
+        counts = self.counts
+        histogram = self.times[timer]
+        queued = self.times["queued"]
+        stack = self.stack
+
+        def on_done(returned):
+            return lambda future: queued.add(time.time() - returned)
+
+        def wrapper(port, header, payload):
+            counts[packets] += 1
+            if payload is not None:
+                try:
+                    counts[size] += len(payload)
+                except TypeError:
+                    pass
+            stack.append(0.0)
+            start = time.time()
+            try:
+                result = method(port, header, payload)
+            finally:
+                elapsed = time.time() - start
+                histogram.add(elapsed - stack.pop())
+                if stack:
+                    stack[-1] += elapsed
+            if isinstance(result, Future) and not result.done():
+                counts["queued"] += 1
+                result.add_done_callback(on_done(time.time()))
+            return result
+        return wrapper
+
+    def counted(self, method, counter):
+        counts = self.counts
+        def wrapper(*args):
+            counts[counter] += 1
+            return method(*args)
+        return wrapper
+
+    def to_dict(self):
+        result = dict(self.counts)
+        result["enabled"] = self.enabled
+        result["seconds"] = time.time() - self.since
+        result["times"] = dict((name, histogram.to_dict()) for name, histogram in self.times.items())
+        return result
+
+    def __str__(self):
+        c = self.counts
+        lines = [
+            "Stats {} ({:.1f}s)".format("on" if self.enabled else "off", time.time() - self.since),
+            " in:  {} pkts, {} bytes".format(c["packets_in"], c["bytes_in"]),
+            " out: {} pkts, {} bytes".format(c["packets_out"], c["bytes_out"]),
+            " bubble {}, passthru {}, close {}".format(c["bubbles"], c["passthrus"], c["closes"]),
+        ]
+        for name in self.TIMERS:
+            lines.append(" {:8} {}".format(name, self.times[name]))
+        return "\n".join(lines)
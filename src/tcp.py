@@ -1,10 +1,15 @@
-from base import NetLayer
+from base import DONE, NetLayer, PacketContext
+from checksum import cksum_add, cksum_done, cksum_fold, cksum_sub, pseudo_header_sum, segment_cksum_ok
+from ip import IPv4Layer
+from util import PortFilterLayer
 
 from tornado import gen
+from tornado.ioloop import PeriodicCallback
 
 import collections
 import datetime
 import dpkt 
+import math
 import struct
 import time
 
@@ -45,6 +50,21 @@ def tcp_dump_opts(optlist):
 def tcp_has_payload(tcp_pkt):
     return bool(tcp_pkt.data)
 
+def tcp_cksum_ok(tcp_pkt, header):
+    return segment_cksum_ok(header["ip_src"], header["ip_dst"], dpkt.ip.IP_PROTO_TCP, str(tcp_pkt))
+
+def tcp_data_sum(tcp_pkt, header):
+    # Partial checksum of a received segment's payload, worked out from its
+    # checksum field and header rather than by summing the payload.
+    # Only correct if the segment's checksum was.
+    s = pseudo_header_sum(header["ip_src"], header["ip_dst"], dpkt.ip.IP_PROTO_TCP, len(tcp_pkt))
+    s = cksum_add(tcp_pkt.pack_hdr() + tcp_pkt.opts, s)
+    return cksum_sub(0xFFFF, s)
+
+def seq_lte(a, b):
+    # a <= b, in 32-bit sequence number space
+    return (b - a) & 0xFFFFFFFF < 0x80000000
+
 # Connection
 def connection_id(pkt, header):
     # Generate a tuple representing the stream 
@@ -109,17 +129,53 @@ class TimestampEstimator(object):
         return int((local_time - l) * self.rate + s) & 0xFFFFFFFF
         #return int(local_time * self.rate + self.offset)
 
-class TCPFilterLayer(NetLayer):
+class TimerWheel(object):
+    # Hashed timer wheel: keys are filed in the slot for their deadline, and
+    # `expire` visits the slots whose time has come, a tick at a time.
+    # Keys can't be cancelled or moved: whoever gets a key back from `expire`
+    # checks whether it's really due, and files it again if its deadline has
+    # been pushed back. So keeping a key alive costs nothing per packet.
+    # A key whose deadline is more than a full turn (`tick` * `slots`) away
+    # comes back early and is filed again. A key only moved to a *sooner*
+    # deadline must be added again, or it can come back up to a full turn
+    # late.
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [set() for i in range(slots)]
+        self.position = int(time.time() / tick)
+
+    def add(self, key, deadline):
+        n = max(int(math.ceil(deadline / self.tick)), self.position + 1)
+        self.slots[n % len(self.slots)].add(key)
+
+    def expire(self, now):
+        # Keys filed in the slots up to `now`
+        n = int(now / self.tick)
+        # Visit each slot at most once, however long it's been
+        self.position = max(self.position, n - len(self.slots))
+        keys = []
+        while self.position < n:
+            self.position += 1
+            slot = self.slots[self.position % len(self.slots)]
+            keys.extend(slot)
+            slot.clear()
+        return keys
+
+class TCPFilterLayer(PortFilterLayer):
     """ Simple TCP layer which will pass packets on certain TCP ports through """
     NAME = "tcp_filter"
+    PORT_KEY = "tcp_port"
+    SERVER_PORT_KEY = "tcp_server_port"
 
-    def __init__(self, *args, **kwargs):
-        super(TCPFilterLayer, self).__init__(**kwargs)
-        self.ports = [int(a) for a in args]
+    @staticmethod
+    def header_ports(header):
+        conn_id = header["tcp_conn"]
+        return (conn_id[0][1], conn_id[1][1])
 
-    def match(self, src, header):
-        x = header["tcp_conn"][1][1] in self.ports or header["tcp_conn"][0][1] in self.ports
-        return x
+    @staticmethod
+    def header_server_port(header):
+        # The connection id is oriented from the host which sent the SYN
+        return (header["tcp_conn"][1][1],)
 
 # Half Connection attributes
 # From the perspective of sending packets back through the link
@@ -139,14 +195,71 @@ class TCPLayer(NetLayer):
     DEFAULT_MSS = 536
     MAX_MSS = 1400
 
+    # Connection table limits
+    MAX_CONNECTIONS = 65536
+    # Seconds without a packet before a connection is forgotten
+    IDLE_TIMEOUT = 600
+    CLOSED_TIMEOUT = 30
+    REAP_INTERVAL_MS = 1000
+    # How many of the least recently used connections are looked at for one
+    # that can be evicted
+    EVICT_SCAN = 256
+
+    CLOSED_STATES = ("CLOSED", "RESET")
+
+    # Duplicate ACKs of the oldest unacknowledged segment that make us send
+    # it again (RFC 5681 fast retransmit)
+    DUP_ACK_THRESHOLD = 3
+
     def __init__(self, *args, **kwargs):
-        self.connections = {}
+        self.max_connections = kwargs.pop("max_connections", self.MAX_CONNECTIONS)
+        self.idle_timeout = kwargs.pop("idle_timeout", self.IDLE_TIMEOUT)
+        self.closed_timeout = kwargs.pop("closed_timeout", self.CLOSED_TIMEOUT)
+        # Received data isn't kept once it's been passed up, unless this is
+        # set: then the last `reassembly_window` bytes from each side are
+        # kept in the connection's "in_buffer"
+        self.reassembly_window = kwargs.pop("reassembly_window", 0)
+        # Least recently used first
+        self.connections = collections.OrderedDict()
         self.timers = collections.defaultdict(TimestampEstimator)
         super(TCPLayer, self).__init__(*args, **kwargs)
+        # When off, incoming checksums are trusted without being checked
+        self.make_toggle("verify")
+        self.opened = 0
+        self.reaped = 0
+        self.evicted = 0
+        self.refused = 0
+        # Set when `make_room` couldn't find enough connections to evict, so
+        # new connections are refused without scanning again until the next
+        # reap
+        self.no_room = False
+        self.retransmits = 0
+        self.wheel = TimerWheel(self.REAP_INTERVAL_MS / 1000.0)
+        self.reaper = PeriodicCallback(self.reap, self.REAP_INTERVAL_MS)
+        self.reaper.start()
+
+    def cleanup(self):
+        self.reaper.stop()
+        super(TCPLayer, self).cleanup()
+
+    def attached(self):
+        # Moved in the tree: start reaping again
+        if not self.reaper.is_running():
+            self.reaper.start()
+        super(TCPLayer, self).attached()
+
+    DISPATCH_KEY = "ip_p"
 
     def match(self, src, header):
         return header["ip_p"] == dpkt.ip.IP_PROTO_TCP
 
+    def dispatch_values(self):
+        return (dpkt.ip.IP_PROTO_TCP,)
+
+    @staticmethod
+    def dispatch_lookup(header):
+        return (header["ip_p"],)
+
     def do_list(self):
         """List open TCP connections."""
         print "Open TCP Connections ({}):".format(len(self.connections))
@@ -157,17 +270,94 @@ class TCPLayer(NetLayer):
             for hconn in (sender, receiver):
                 rel_seq = hconn.get('seq', -1) - hconn.get('seq_start', -1)
                 rel_ack = hconn.get('ack', -1) - hconn.get('ack_start', -1)
-                ip_src = hconn.get("ip_src", "(no ip)")
+                ip_src = IPv4Layer.pretty_ip(hconn["ip_src"]) if "ip_src" in hconn else "(no ip)"
                 port = hconn.get("sport", -1)
                 state = hconn.get("state", "no-state")
                 hconn["_debug"] = "{ip_src}:{port} [{state} S={seq} A={ack}]".format(ip_src=ip_src, port=port, state=state, seq=rel_seq, ack=rel_ack)
             print " - {0} --> {1}".format(sender["_debug"], receiver["_debug"])
 
+    def closed(self, conn):
+        return conn[0].get("state") in self.CLOSED_STATES and conn[1].get("state") in self.CLOSED_STATES
+
+    def evictable(self, conn):
+        # Connections that are only being passed through, or are over, can
+        # be forgotten without breaking anything
+        return ("state" not in conn[0] and "state" not in conn[1]) or self.closed(conn)
+
+    def deadline(self, conn):
+        return conn["last_seen"] + (self.closed_timeout if self.closed(conn) else self.idle_timeout)
+
+    def make_room(self):
+        # Evict the least recently used evictable connections until there's
+        # room for a new one. Returns False if there aren't enough.
+        excess = len(self.connections) - self.max_connections + 1
+        victims = []
+        for i, (conn_id, conn) in enumerate(self.connections.iteritems()):
+            if i >= self.EVICT_SCAN or len(victims) >= excess:
+                break
+            if self.evictable(conn):
+                victims.append(conn_id)
+        for conn_id in victims:
+            del self.connections[conn_id]
+        self.evicted += len(victims)
+        self.no_room = len(victims) < excess
+        return not self.no_room
+
+    def reap(self):
+        # Forget connections that have been closed or idle for long enough
+        now = time.time()
+        self.no_room = False
+        for conn_id in self.wheel.expire(now):
+            conn = self.connections.get(conn_id)
+            if conn is None:
+                continue
+            deadline = self.deadline(conn)
+            if deadline > now:
+                self.wheel.add(conn_id, deadline)
+                continue
+            del self.connections[conn_id]
+            self.reaped += 1
+            if not self.evictable(conn):
+                # Idle, but never closed: let the layers above clean up
+                self.log("Reaping idle connection {}", conn["count"])
+                for src in (conn["sender"], conn["receiver"]):
+                    self.add_future(self.close_bubble(src, PacketContext(tcp_conn=conn_id, reset=True)))
+
+    def do_table(self, *args):
+        """table [max|idle|closed <n>] - Show connection table size & expiry, or set a limit or timeout (s)."""
+        if args:
+            if len(args) != 2 or args[0] not in ("max", "idle", "closed"):
+                raise Exception("Unknown table command '{}'".format(" ".join(args)))
+            if args[0] == "max":
+                self.max_connections = max(1, int(args[1]))
+                self.no_room = False
+            else:
+                setattr(self, args[0] + "_timeout", float(args[1]))
+        passthru = sum(1 for conn in self.connections.itervalues() if "state" not in conn[0] and "state" not in conn[1])
+        closed = sum(1 for conn in self.connections.itervalues() if self.closed(conn))
+        return "Connections: {} (max {}), {} passthrough-only, {} closed\n" \
+               "Opened {}, reaped {}, evicted {}, refused {}\n" \
+               "Timeouts: idle {}s, closed {}s\n" \
+               "Unacknowledged: {} segments, {} retransmitted".format(
+                len(self.connections), self.max_connections, passthru, closed,
+                self.opened, self.reaped, self.evicted, self.refused,
+                self.idle_timeout, self.closed_timeout,
+                sum(len(conn[half].get("unacked", ())) for conn in self.connections.itervalues() for half in (0, 1)),
+                self.retransmits)
+
+    def do_window(self, size=None):
+        """window [bytes] - Show or set how much received data is kept per connection (0: none)."""
+        if size is not None:
+            self.reassembly_window = max(0, int(size))
+        return "Reassembly window: {} bytes".format(self.reassembly_window)
+
     @gen.coroutine
     def on_read(self, src, header, payload):
         pkt = payload
 
-        #TODO: validate checksums / packet
+        if self.verify and not tcp_cksum_ok(pkt, header):
+            self.log("Dropping segment with bad checksum")
+            return
 
         tcp_opts = dpkt.tcp.parse_opts(pkt.opts)
         tcp_opts_dict = dict(tcp_opts)
@@ -179,14 +369,32 @@ class TCPLayer(NetLayer):
         # For now, assume that connections are symmetric
         if conn_id[::-1] in self.connections:
             conn_id = conn_id[::-1]
-            conn = self.connections[conn_id]
+            conn = self.connections.pop(conn_id)
         elif conn_id not in self.connections:
+            if self.resolve_child(src, PacketContext(tcp_conn=conn_id)) is None:
+                # No layer wants this connection, so don't terminate it:
+                # forward it untouched from now on
+                self.bypass(header, pkt.sport, pkt.dport)
+                yield self.passthru(src, header, payload)
+                return
+
+            if len(self.connections) >= self.max_connections and (self.no_room or not self.make_room()):
+                # Table full of connections we're modifying: leave this one alone
+                self.refused += 1
+                yield self.passthru(src, header, payload)
+                return
+
             # conn_id[0] corresponds to conn[conn["server"]]
             # conn_id[1] corresponds to conn[conn["receiver"]]
-            conn = {src: {}, dst: {}, "count": len(self.connections), "sender": src, "receiver": dst}
-            self.connections[conn_id] = conn
+            conn = {src: {}, dst: {}, "count": self.opened, "sender": src, "receiver": dst}
+            self.opened += 1
+            self.wheel.add(conn_id, time.time() + self.idle_timeout)
         else:
-            conn = self.connections[conn_id]
+            conn = self.connections.pop(conn_id)
+        # Move it to the most recently used end
+        self.connections[conn_id] = conn
+        conn["last_seen"] = time.time()
+        was_closed = self.closed(conn)
 
 
         src_conn = conn[src]
@@ -207,7 +415,8 @@ class TCPLayer(NetLayer):
             ts_val, ts_ecr = None, None
 
         if self.debug:
-            self.log("TCP {}{} {} {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}",
+            # Built only for the messages that will be logged
+            self.log(lambda: "TCP {}{} {} {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}".format(
                     "AB"[src], "->",
                     conn["count"],
                     time.clock(), 
@@ -224,20 +433,28 @@ class TCPLayer(NetLayer):
                     pkt.data.replace("\n", "\\n")[:8] if pkt.data else None,
                     ts_val,
                     ts_ecr
-                )
+                ))
 
         if tcp_has_payload(pkt):
             if src_conn.get("state") == "ESTABLISHED":
                 data = pkt.data
                 src_conn["payload_sizes"][len(data)] += 1
-                src_conn["in_buffer"] += data
+                if self.reassembly_window:
+                    src_conn["in_buffer"] = (src_conn["in_buffer"] + data)[-self.reassembly_window:]
                 src_conn["ack"] += len(data)
+                # If this data is forwarded as-is, its checksum can be reused,
+                # but only once it has been checked: otherwise a corrupted
+                # payload would go out under a freshly valid checksum
+                if self.verify:
+                    dst_conn["rx_data"] = (data, tcp_data_sum(pkt, header))
+                else:
+                    dst_conn.pop("rx_data", None)
 
                 # ACK the data
                 yield self.write_packet(src, conn_id, flags="A")
 
                 # Bubble up data to next layer
-                yield self.bubble(src, {"tcp_conn": conn_id}, data)
+                yield self.bubble(src, PacketContext(tcp_conn=conn_id), data)
 
 
         if pkt.flags & dpkt.tcp.TH_SYN:
@@ -253,7 +470,9 @@ class TCPLayer(NetLayer):
 
             dst_conn["out_buffer"] = ""
             dst_conn["in_buffer"] = ""
-            dst_conn["unacked"] = []
+            # (seq, payload) of segments sent but not yet acknowledged
+            dst_conn["unacked"] = collections.deque()
+            dst_conn["dup_acks"] = 0
 
             dst_conn["seq"] = pkt.seq
             src_conn["ack"] = pkt.seq + 1
@@ -315,6 +534,10 @@ class TCPLayer(NetLayer):
                 # Forward SYN
                 yield self.write_packet(dst, conn_id, flags="S")
 
+        if pkt.flags & dpkt.tcp.TH_ACK:
+            # Including FIN segments, which nearly always acknowledge data too
+            yield self.handle_ack(src, conn_id, pkt)
+
         if pkt.flags & dpkt.tcp.TH_FIN:
             if src_conn.get("state") == "ESTABLISHED":
                 src_conn["ack"] += 1
@@ -322,7 +545,7 @@ class TCPLayer(NetLayer):
                 if dst_conn.get("state") == "ESTABLISHED":
                     dst_conn["state"] = "FIN-WAIT-1"
                     # Forward FIN - nope! send a close msg
-                    yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
+                    yield self.close_bubble(src, PacketContext(tcp_conn=conn_id, reset=False))
                     yield self.write_packet(dst, conn_id, flags="FA")
                     dst_conn["seq"] += 1
 
@@ -338,8 +561,8 @@ class TCPLayer(NetLayer):
                 yield self.write_packet(src, conn_id, flags="A")
 
                 # Bubble up close event
-                yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
-                #TODO: prune connection obj
+                yield self.close_bubble(src, PacketContext(tcp_conn=conn_id, reset=False))
+                # The reaper forgets the connection after `closed_timeout`
 
         elif pkt.flags & dpkt.tcp.TH_ACK:
             if src_conn.get("state") == "SYN-RECIEVED":
@@ -356,8 +579,8 @@ class TCPLayer(NetLayer):
                 src_conn["state"] = "CLOSED"
 
                 # Bubble up close event - already closed!
-                #yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
-                #TODO: prune connection obj
+                #yield self.close_bubble(src, PacketContext(tcp_conn=conn_id, reset=False))
+                # The reaper forgets the connection after `closed_timeout`
 
 
         if pkt.flags & dpkt.tcp.TH_RST:
@@ -375,8 +598,8 @@ class TCPLayer(NetLayer):
                     yield self.passthru(src, header, payload)
 
                 # Bubble up close event
-                yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": True})
-                #TODO: prune connection obj
+                yield self.close_bubble(src, PacketContext(tcp_conn=conn_id, reset=True))
+                # The reaper forgets the connection after `closed_timeout`
             else:
                 # This isn't on a actively modified connection, passthru
                 self.log("RST passthru")
@@ -385,14 +608,52 @@ class TCPLayer(NetLayer):
         if "state" not in dst_conn: # Not handled
             yield self.passthru(src, header, payload)
 
-
-    @gen.coroutine
+        if not was_closed and self.closed(conn):
+            # It's now due sooner than it was filed for
+            self.wheel.add(conn_id, self.deadline(conn))
+
+
+    # coroutine
+    def handle_ack(self, src, conn_id, pkt):
+        # Forget the segments we sent to `src` that it has now acknowledged,
+        # and send the oldest remaining one again if `src` keeps asking for it
+        conn = self.connections[conn_id][src]
+        unacked = conn.get("unacked")
+        if not unacked:
+            return DONE
+        ack = pkt.ack
+        acked = False
+        while unacked:
+            seq, payload = unacked[0]
+            end = seq + len(payload)
+            if seq_lte(end, ack):
+                unacked.popleft()
+                acked = True
+            elif seq_lte(ack, seq):
+                break
+            else:
+                # Part of the segment got through
+                unacked[0] = (ack, payload[(ack - seq) & 0xFFFFFFFF:])
+                acked = True
+                break
+
+        if acked or pkt.data or pkt.flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN) or not unacked or (unacked[0][0] & 0xFFFFFFFF) != ack:
+            conn["dup_acks"] = 0
+            return DONE
+        conn["dup_acks"] += 1
+        if conn["dup_acks"] < self.DUP_ACK_THRESHOLD:
+            return DONE
+        conn["dup_acks"] = 0
+        self.retransmits += 1
+        seq, payload = unacked[0]
+        self.log("Retransmitting {} bytes @ {}", len(payload), seq)
+        return self.send_segment(src, conn, seq, "AP", payload)
+
+    # coroutine
     def write_packet(self, dst, conn_id, flags="A"):
         conn = self.connections[conn_id][dst]
-        header = conn["ip_header"]
         payload = None
         seq = conn["seq"]
-        ack = conn.get("ack", 0)
         payload_size = conn.get("max_segment_size", self.DEFAULT_MSS)
 
         if conn["out_buffer"]:
@@ -402,6 +663,13 @@ class TCPLayer(NetLayer):
             conn["unacked"].append((seq, payload))
             conn["seq"] += len(payload)
 
+        return self.send_segment(dst, conn, seq, flags, payload)
+
+    # coroutine
+    def send_segment(self, dst, conn, seq, flags, payload):
+        header = conn["ip_header"]
+        ack = conn.get("ack", 0)
+
         bflags = tcp_dump_flags(flags)
         estimated_ts_val = self.timers[conn["ip_src"]].get_time()
         if estimated_ts_val is None or estimated_ts_val == 0:
@@ -428,7 +696,7 @@ class TCPLayer(NetLayer):
             pkt.data = payload
 
         if self.debug:
-            self.log("TCP {}{}   {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}",
+            self.log(lambda: "TCP {}{}   {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}".format(
                     "->", "AB"[dst],
                     time.clock(), 
                     "-", #hosts.get(header["ip_src"], "?"),
@@ -444,14 +712,30 @@ class TCPLayer(NetLayer):
                     pkt.data.replace("\n", "\\n")[:8] if pkt.data else None,
                     conn.get('ts_val', 0),
                     conn.get('ts_ecr', 0)
-                )
+                ))
+        # Only the header differs from what we received if the payload is
+        # being forwarded unchanged, so reuse the payload's partial sum
+        tcp_header = pkt.pack_hdr() + pkt.opts
+        s = pseudo_header_sum(conn["ip_src"], conn["ip_dst"], dpkt.ip.IP_PROTO_TCP, len(tcp_header) + len(pkt.data))
+        s = cksum_add(tcp_header, s)
+        rx_data = conn.get("rx_data")
+        if rx_data is not None and rx_data[0] == pkt.data:
+            s = cksum_fold(s + rx_data[1])
+        else:
+            s = cksum_add(pkt.data, s)
+        pkt.sum = cksum_done(s)
+
         #self.connections[conn_id][dst] = conn
-        # Don't stringify packet so the IP layer can calculate the checksum for us
-        yield self.write_back(dst, header, pkt)
+        return self.write_back(dst, header, pkt)
 
     @gen.coroutine
     def write(self, dst, header, data):
-        dst_conn = self.connections[header["tcp_conn"]][dst]
+        conn = self.connections.get(header["tcp_conn"])
+        if conn is None:
+            # Reaped or evicted while the layers above were busy with it
+            self.log("Dropping write to a forgotten connection")
+            return
+        dst_conn = conn[dst]
         if data is not None:
             dst_conn["out_buffer"] += data
             while len(dst_conn["out_buffer"]) >= dst_conn.get("min_payload", 1):
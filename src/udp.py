@@ -1,6 +1,9 @@
 from base import NetLayer
+from checksum import cksum_add, cksum_done, pseudo_header_sum, segment_cksum_ok
+from util import PortFilterLayer
 
 import dpkt 
+import struct
 
 from tornado import gen
 
@@ -11,41 +14,92 @@ def udp_connection_id(pkt, header):
     # ((ip, port), (ip, port))
     return tuple(sorted(((header["ip_src"], pkt.sport), (header["ip_dst"], pkt.dport))))
 
+class UDPHeaderTemplate(object):
+    # Precompiled UDP header for datagrams forged on one flow
+    # The pseudo-header and port words are summed once; per datagram only
+    # the length and payload are added in.
+    __slots__ = ("ports", "partial_sum")
+
+    PORTS = struct.Struct("!HH")
+    LENGTH_CKSUM = struct.Struct("!HH")
+
+    def __init__(self, src, dst, sport, dport):
+        self.ports = self.PORTS.pack(sport, dport)
+        self.partial_sum = cksum_add(self.ports, pseudo_header_sum(src, dst, dpkt.ip.IP_PROTO_UDP))
+
+    def build(self, data):
+        length = 8 + len(data)
+        # The length is counted twice: once in the pseudo-header, once in the UDP header
+        cksum = cksum_done(cksum_add(data, self.partial_sum + length + length)) or 0xFFFF
+        return "".join((self.ports, self.LENGTH_CKSUM.pack(length, cksum), data))
+
 class UDPLayer(NetLayer):
     NAME = "udp"
     seen_ports = set()
+    # Maximum number of flows to keep header templates for
+    TEMPLATE_CACHE_MAX = 4096
+
+    def __init__(self, *args, **kwargs):
+        super(UDPLayer, self).__init__(*args, **kwargs)
+        self.templates = {}
+        # When off, incoming checksums are trusted without being checked
+        self.make_toggle("verify")
+
+    DISPATCH_KEY = "ip_p"
 
     def match(self, src, header):
         return header["ip_p"] == dpkt.ip.IP_PROTO_UDP
 
+    def dispatch_values(self):
+        return (dpkt.ip.IP_PROTO_UDP,)
+
+    @staticmethod
+    def dispatch_lookup(header):
+        return (header["ip_p"],)
+
     # coroutine
     def on_read(self, src, header, data):
         pkt = data
 
-        header["udp_sport"] = pkt.sport
-        header["udp_dport"] = pkt.dport
+        if self.verify and pkt.sum and not segment_cksum_ok(header["ip_src"], header["ip_dst"], dpkt.ip.IP_PROTO_UDP, str(pkt)):
+            self.log("Dropping datagram with bad checksum")
+            return
 
-        header["udp_conn"] = udp_connection_id(pkt, header)
+        header.udp_sport = pkt.sport
+        header.udp_dport = pkt.dport
 
+        header.udp_conn = udp_connection_id(pkt, header)
+
+        child = self.resolve_child(src, header)
+        if child is None:
+            # Nothing wants this flow: forward the datagram as-is from now on
+            self.bypass(header, pkt.sport, pkt.dport)
+            return self.passthru(src, header, pkt)
         return self.bubble(src, header, pkt.data)
 
     # coroutine
     def write(self, dst, header, data):
         header["ip_p"] = dpkt.ip.IP_PROTO_UDP
-        pkt = dpkt.udp.UDP(sport=header["udp_sport"], dport=header["udp_dport"])
-        pkt.data = data 
-        pkt.ulen = len(pkt)
+        key = (header["ip_src"], header["ip_dst"], header["udp_sport"], header["udp_dport"])
+        template = self.templates.get(key)
+        if template is None:
+            if len(self.templates) >= self.TEMPLATE_CACHE_MAX:
+                self.templates.clear()
+            template = self.templates[key] = UDPHeaderTemplate(*key)
 
-        # Return dpkt.udp.UDP instance so IP layer can calc checksum
-        return self.write_back(dst, header, pkt)
+        return self.write_back(dst, header, template.build(data))
 
-class UDPFilterLayer(NetLayer):
+class UDPFilterLayer(PortFilterLayer):
     NAME = "udp_filter"
     """ Pass all UDP packets with a given port through """
+    PORT_KEY = "udp_port"
+    SERVER_PORT_KEY = "udp_dport"
 
-    def __init__(self, *args, **kwargs):
-        super(UDPFilterLayer, self).__init__(**kwargs)
-        self.ports = [int(a) for a in args]
+    @staticmethod
+    def header_ports(header):
+        return (header["udp_sport"], header["udp_dport"])
 
-    def match(self, src, header):
-        return header["udp_dport"] in self.ports or header["udp_sport"] in self.ports
+    @staticmethod
+    def header_server_port(header):
+        # UDP has no handshake, so only datagrams sent *to* a port match
+        return (header["udp_dport"],)
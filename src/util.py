@@ -1,10 +1,200 @@
+import collections
 import tornado.gen as gen
 import subprocess
 
 from base import NetLayer
 
+def parse_ports(specs):
+    # Build a port set from numbers, ranges ("8000-9000") and lists ("80,443")
+    ports = set()
+    for spec in specs:
+        for part in str(spec).split(","):
+            part = part.strip()
+            if not part:
+                continue
+            if "-" in part:
+                low, high = part.split("-", 1)
+                ports.update(xrange(int(low), int(high) + 1))
+            else:
+                ports.add(int(part))
+    for port in ports:
+        if not 0 <= port <= 0xFFFF:
+            raise ValueError("Invalid port {}".format(port))
+    return frozenset(ports)
+
+def format_ports(ports):
+    # Inverse of parse_ports, collapsing runs into ranges
+    ranges = []
+    for port in sorted(ports):
+        if ranges and ranges[-1][1] == port - 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    return ",".join(str(low) if low == high else "{}-{}".format(low, high) for low, high in ranges)
+
+class PortFilterLayer(NetLayer):
+    # Passes packets on a set of ports through to its children
+    # Subclasses say where the ports are in the header, see TCPFilterLayer
+    # Ports can be given as numbers or ranges, e.g. PortFilterLayer(80, "8000-9000")
+    # With `server_only`, only the server's port is checked
+    PORT_KEY = None
+    SERVER_PORT_KEY = None
+
+    def __init__(self, *args, **kwargs):
+        self.server_only = kwargs.pop("server_only", False)
+        super(PortFilterLayer, self).__init__(**kwargs)
+        self.ports = parse_ports(args)
+
+    @property
+    def DISPATCH_KEY(self):
+        return self.SERVER_PORT_KEY if self.server_only else self.PORT_KEY
+
+    @property
+    def SYMMETRIC_MATCH(self):
+        # The server's port is only found by looking at which way a packet goes
+        return not self.server_only
+
+    @staticmethod
+    def header_ports(header):
+        # Override me  -- both ports of the packet
+        return ()
+
+    @staticmethod
+    def header_server_port(header):
+        # Override me  -- the server's port, as a 1-tuple
+        return ()
+
+    def match(self, src, header):
+        for port in self.dispatch_lookup(header):
+            if port in self.ports:
+                return True
+        return False
+
+    def dispatch_values(self):
+        return self.ports
+
+    def dispatch_lookup(self, header):
+        if self.server_only:
+            return self.header_server_port(header)
+        return self.header_ports(header)
+
+    def do_ports(self):
+        """List the ports matched by this filter."""
+        return "{} ports: {}".format("Server" if self.server_only else "Any", format_ports(self.ports))
+
+    def do_add(self, *specs):
+        """add <ports>... - Match more ports (e.g. 80 or 8000-9000)."""
+        self.ports = self.ports | parse_ports(specs)
+        self.invalidate_dispatch()
+        return self.do_ports()
+
+    def do_rm(self, *specs):
+        """rm <ports>... - Stop matching some ports."""
+        self.ports = self.ports - parse_ports(specs)
+        self.invalidate_dispatch()
+        return self.do_ports()
+
+    def do_server_only(self):
+        """Toggle matching only the server's port."""
+        self.server_only = not self.server_only
+        self.invalidate_dispatch()
+        return self.do_ports()
+
+class ChunkBuffer(object):
+    # Data received but not passed on yet, kept as the chunks it arrived in,
+    # so appending doesn't copy. A chunk is only searched for a newline once,
+    # however many times `readline` comes back for more.
+    def __init__(self):
+        self.chunks = collections.deque()
+        # Offset of the first unread byte in chunks[0]
+        self.start = 0
+        # Number of leading chunks known not to contain a newline
+        self.scanned = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def readline(self):
+        # Remove & return the next line, including its "\n", or return None
+        # if there isn't a whole line yet
+        chunks = self.chunks
+        if not chunks:
+            return None
+        if not self.scanned:
+            # Usually the line is all in the first chunk
+            first = chunks[0]
+            start = self.start
+            end = first.find("\n", start) + 1
+            if end:
+                if end == len(first):
+                    chunks.popleft()
+                    self.start = 0
+                else:
+                    self.start = end
+                self.size -= end - start
+                return first[start:end]
+            self.scanned = 1
+        for i in xrange(self.scanned, len(chunks)):
+            end = chunks[i].find("\n")
+            if end >= 0:
+                return self.take(i, end + 1)
+        self.scanned = len(chunks)
+        return None
+
+    def take(self, i, end):
+        # Remove & return everything up to offset `end` of chunk `i`
+        chunks = self.chunks
+        if i == 0:
+            data = chunks[0][self.start:end]
+        else:
+            parts = [chunks.popleft()[self.start:]]
+            for j in xrange(i - 1):
+                parts.append(chunks.popleft())
+            parts.append(chunks[0][:end])
+            data = "".join(parts)
+        if end == len(chunks[0]):
+            chunks.popleft()
+            self.start = 0
+        else:
+            self.start = end
+        self.scanned = 0
+        self.size -= len(data)
+        return data
+
+    def unread(self, data):
+        # Put `data` back in front of what's left
+        if data:
+            if self.start:
+                self.chunks[0] = self.chunks[0][self.start:]
+                self.start = 0
+            self.chunks.appendleft(data)
+            self.size += len(data)
+            self.scanned = 0
+
+    def read(self):
+        # Remove & return everything
+        if not self.chunks:
+            return ""
+        self.chunks[0] = self.chunks[0][self.start:]
+        data = "".join(self.chunks)
+        self.chunks.clear()
+        self.start = 0
+        self.scanned = 0
+        self.size = 0
+        return data
+
 class LineBufferLayer(NetLayer):
     # Buffers incoming data line-by-line
+    # Layers above can call header["lbl_disable"](src) to get the data as it
+    # arrives instead, and header["lbl_enable"](src) to go back to lines.
+    # header["lbl_unread"](src, data) hands back data they were given but
+    # don't want yet, to be passed up again (in lines, if enabled) next.
     NAME = "linebuffer"
     CONN_ID_KEY = "tcp_conn"
 
@@ -13,52 +203,59 @@ class LineBufferLayer(NetLayer):
         self.buffers = {}
         self.enabled = {}
         self.closed = {}
+        self.callbacks = {}
+
+    def open(self, conn_id):
+        self.buffers[conn_id] = {0: ChunkBuffer(), 1: ChunkBuffer()}
+        enabled = self.enabled[conn_id] = {0: True, 1: True}
+        self.closed[conn_id] = {0: False, 1: False}
+
+        def lbl_enable(s):
+            enabled[s] = True
+        def lbl_disable(s):
+            enabled[s] = False
+        buffers = self.buffers[conn_id]
+        def lbl_unread(s, data):
+            buffers[s].unread(data)
+        self.callbacks[conn_id] = (lbl_enable, lbl_disable, lbl_unread)
         
     @gen.coroutine
     def on_read(self, src, header, data):
         conn_id = header[self.CONN_ID_KEY]
         if conn_id not in self.buffers:
-            self.buffers[conn_id] = {0: "", 1: ""}
-            self.enabled[conn_id] = {0: True, 1: True}
-            self.closed[conn_id] = {0: False, 1: False}
-
-        def lbl_enable(s):
-            self.enabled[conn_id][s] = True
-        def lbl_disable(s):
-            self.enabled[conn_id][s] = False
-
-        header["lbl_enable"] = lbl_enable
-        header["lbl_disable"] = lbl_disable
+            self.open(conn_id)
+        header["lbl_enable"], header["lbl_disable"], header["lbl_unread"] = self.callbacks[conn_id]
 
+        buff = self.buffers[conn_id][src]
         if data is None:
-            buff = self.buffers[conn_id][src]
-            self.buffers[conn_id][src] = ""
-            yield self.bubble(src, header, buff)
-        else:
-            self.buffers[conn_id][src] += data
-            if self.enabled[conn_id][src]:
-                while '\n' in self.buffers[conn_id][src]:
-                    line, _newline, self.buffers[conn_id][src] = self.buffers[conn_id][src].partition('\n')
-                    yield self.bubble(src, header, line + "\n")
+            yield self.bubble(src, header, buff.read())
+            return
 
-            if not self.enabled[conn_id][src]:
-                buff = self.buffers[conn_id][src]
-                self.buffers[conn_id][src] = ""
-                yield self.bubble(src, header, buff)
+        buff.append(data)
+        enabled = self.enabled[conn_id]
+        # Layers above may switch modes while handling what we pass them
+        while buff:
+            if enabled[src]:
+                line = buff.readline()
+                if line is None:
+                    break
+                yield self.bubble(src, header, line)
+            else:
+                yield self.bubble(src, header, buff.read())
 
     @gen.coroutine
     def on_close(self, src, header):
         conn_id = header[self.CONN_ID_KEY]
         if conn_id in self.buffers:
-            buff = self.buffers[conn_id][src]
-            self.buffers[conn_id][src] = ""
+            buff = self.buffers[conn_id][src].read()
             yield self.bubble(src, header, buff)
 
             self.closed[conn_id][src] = True
-            if all(self.closed[conn_id]): 
+            if all(self.closed[conn_id].values()):
                 del self.closed[conn_id]
                 del self.enabled[conn_id]
                 del self.buffers[conn_id]
+                del self.callbacks[conn_id]
         yield self.close_bubble(src, header)
 
 class MultiOrderedDict(list):
@@ -73,9 +270,7 @@ class MultiOrderedDict(list):
         if key in self.d:
             #print "Removing", key, ":", self.d[key]
             del self.d[key]
-            for (i, (k, v)) in enumerate(self):
-                if k.lower() == key:
-                    self.pop(i)
+            self[:] = [(k, v) for (k, v) in self if k.lower() != key]
 
     def first(self, key, default=None):
         key = key.lower()